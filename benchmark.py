@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+############################################
+#                                          #
+# /!\ PYTHON 3 ONLY                        #
+#                                          #
+# ICHIMOKU CLOUDS BENCHMARK                #
+#                                          #
+# TIMES EACH STAGE ON SYNTHETIC DATA :     #
+#    - Replayed fetching (optional)        #
+#    - Quote data parsing (JSON)           #
+#    - H4 transformation                   #
+#    - Ichimoku processing                 #
+#    - Panel processing (all markets)      #
+#    - Bar by bar Ichimoku state (checked) #
+#    - Score processing (single & batch)   #
+#    - Message writing                     #
+#                                          #
+############################################
+
+###################################################### IMPORTS #####################################################################
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+import ichimoku
+
+##################################################### FUNCTIONS ####################################################################
+
+#
+# Parse args from command line
+#
+def parse_args():
+	parser = argparse.ArgumentParser(prog='./benchmark.py', description="Benchmark Ichimoku processing stages on synthetic data (no network access).")
+
+	parser.add_argument("-s",  "--symbols", type=int, help="Number of synthetic markets. Default 100.", default=100)
+	parser.add_argument("-b",  "--bars", type=int, help="Number of 1h bars per market. Default 800.", default=800)
+	parser.add_argument("-r",  "--repeat", type=int, help="Number of runs of each stage (best run is kept). Default 3.", default=3)
+	parser.add_argument("-c",  "--config", type=str, help="Ichimoku settings. Default '9,26,52'.",  choices=['9,26,52', '7,22,44'], default='9,26,52')
+	parser.add_argument("-o",  "--output", type=str, help="JSON file where results are written. Default stdout only.")
+	parser.add_argument("--replay", type=str, help="Directory of 1h chart responses recorded with 'ichimoku.py --record', replayed instead of synthetic markets.")
+	parser.add_argument("--compare", type=str, help="JSON results file of a previous run to compare with.")
+
+	return parser.parse_args()
+
+
+#
+# Build Yahoo chart JSON for one market : 1h bars of an European session (9h - 17h, Paris)
+#
+def synthetic_chart(symbol, bars, seed):
+	rng = np.random.default_rng(seed)
+
+	days		= pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=bars // 9 + 1, tz='Europe/Paris')
+	hours		= pd.to_timedelta(np.arange(9, 18), unit='h')
+	timestamps	= (days.values.reshape(-1, 1) + hours.values.reshape(1, -1)).ravel()[-bars:]
+	timestamps	= pd.DatetimeIndex(timestamps).tz_localize('Europe/Paris').as_unit('s').asi8
+
+	close	= 100 + np.cumsum(rng.normal(0, 1, bars))
+	opn	= close + rng.normal(0, 0.5, bars)
+	high	= np.maximum(opn, close) + rng.random(bars)
+	low	= np.minimum(opn, close) - rng.random(bars)
+	volume	= rng.integers(1, 10000, bars)
+
+	body = {
+		'meta':		{'symbol': symbol, 'exchangeName': 'PAR', 'exchangeTimezoneName': 'Europe/Paris', 'gmtoffset': 3600},
+		'timestamp':	timestamps.tolist(),
+		'indicators':	{'quote': [{'open': opn.tolist(), 'high': high.tolist(), 'low': low.tolist(), 'close': close.tolist(), 'volume': volume.tolist()}]},
+	}
+
+	return json.dumps({'chart': {'result': [body], 'error': None}})
+
+
+#
+# Run function on each input, returns best total time over repeated runs & last outputs
+#
+def timed(function, inputs, repeat):
+	best = None
+
+	for r in range(0, repeat):
+		start	= time.perf_counter()
+		outputs	= [function(x) for x in inputs]
+		elapsed	= time.perf_counter() - start
+
+		if (best == None) or (elapsed < best):
+			best = elapsed
+
+	return best, outputs
+
+
+#
+# Update Ichimoku state bar by bar over a market, returns values of last bar
+#
+def state_last_bar(df, config):
+	state	= ichimoku.IchimokuState(config)
+	row	= None
+
+	for bar in zip(*(df[name].to_numpy(dtype=float) for name in ['open', 'high', 'low', 'close'])):
+		row = state.update(*bar)
+
+	return row
+
+
+#
+# Current git commit of the benchmarked code (if any)
+#
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		return ""
+
+
+#
+# Main function
+#
+def main():
+	args = parse_args()
+
+	config = tuple(map(int, args.config.split(',')))
+	ichimoku.apply_settings(ichimoku.current_settings()._replace(configs=(config,), intervals=('1h',), output='TXT', replay_dir=args.replay, rate_limit=0))
+
+	stages = {}
+
+	# Recorded markets are replayed through the fetching stage, synthetic ones are decoded by get_quote_data
+	if (args.replay != None):
+		suffix	= ichimoku.record_key("", "?range=4mo&interval=1h")
+		symbols	= sorted(name[:-len(suffix)] for name in os.listdir(args.replay) if name.endswith(suffix))
+
+		stages['fetch_all'], charts	= timed(lambda x: dict(ichimoku.fetch_all(symbols, '1h')), [None], args.repeat)
+		charts				= [charts[0][symbol] for symbol in symbols]
+		decode				= lambda data: data
+	else:
+		symbols	= ["SYM" + str(i) for i in range(0, args.symbols)]
+		charts	= [synthetic_chart(symbol, args.bars, seed) for seed, symbol in enumerate(symbols)]
+		decode	= json.loads
+
+	# Each stage is fed with outputs of the previous one
+	stages['get_quote_data'], frames	= timed(lambda x: ichimoku.get_quote_data(x[0], '1h', decode(x[1])), list(zip(symbols, charts)), args.repeat)
+	names					= [symbol for symbol, df in zip(symbols, frames) if df is not None]
+	frames					= [df for df in frames if df is not None]
+	stages['transform_four_hours'], h4	= timed(lambda df: ichimoku.transform_four_hours(df), frames, args.repeat)
+	stages['process_panel'], panel		= timed(lambda x: ichimoku.process_panel([ichimoku.MarketFrame(name, '1h', df) for name, df in zip(names, frames)], '1h'), [None], args.repeat)
+	stages['IchimokuState'], rows		= timed(lambda df: state_last_bar(df, config), frames, args.repeat)
+	stages['processIchimoku'], frames	= timed(lambda df: ichimoku.processIchimoku(df.copy(), config), frames, args.repeat)
+
+	# Bar by bar state must give same last bar values as processIchimoku
+	for name, row, df in zip(names, rows, frames):
+		if not all(np.isclose(row[field], df[field].iloc[-1], equal_nan=True) for field in ichimoku.SCORE_FIELDS + ['KIJUNSEN', 'TENKANSEN', 'SSA', 'SSB']):
+			raise SystemExit("ERROR: IchimokuState values differ from processIchimoku ones for " + name + ".")
+	stages['process_score'], scores		= timed(lambda df: ichimoku.process_score(df), frames, args.repeat)
+	stages['score_batch'], batch		= timed(lambda x: ichimoku.score_batch(np.stack([ichimoku.signal_tail(df) for df in frames])), [None], args.repeat)
+
+	scores = {('1h', config): dict(zip(names, scores))}
+	stages['write_email'], msg		= timed(lambda x: ichimoku.write_email(scores, {}), [None], args.repeat)
+
+	results = {
+		'commit':	git_commit(),
+		'python':	platform.python_version(),
+		'numpy':	np.__version__,
+		'pandas':	pd.__version__,
+		'symbols':	len(symbols),
+		'replay':	args.replay,
+		'bars':		args.bars,
+		'repeat':	args.repeat,
+		'config':	args.config,
+		'h4_markets':	len([df for df in h4 if df is not None]),
+		'stages':	{name: {'seconds': seconds, 'per_symbol_ms': seconds * 1000 / len(symbols)} for name, seconds in stages.items()},
+	}
+
+	previous = None
+	if (args.compare != None):
+		with open(args.compare) as f:
+			previous = json.load(f)
+
+	print("BENCHMARK " + str(len(symbols)) + " markets" + ((" replayed from " + args.replay) if (args.replay != None) else (" x " + str(args.bars) + " bars")) + " (" + results['commit'] + ")\n")
+	for name, stage in results['stages'].items():
+		line = "\t- " + name.ljust(22) + "{:10.4f}".format(stage['seconds']) + " s"
+		if (previous != None) and (name in previous['stages']) and (stage['seconds'] > 0):
+			line = line + "  (x" + "{:.2f}".format(previous['stages'][name]['seconds'] / stage['seconds']) + " vs " + previous.get('commit', '') + ")"
+		print(line)
+
+	if (args.output != None):
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2)
+
+
+################################################### START PROGRAM ##################################################################
+if __name__ == "__main__":
+	main()
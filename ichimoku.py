@@ -17,15 +17,11 @@
 ############################################
 
 ###################################################### IMPORTS #####################################################################
-import requests
-import pandas as pd
 import os
 import string
 import sys
-import urllib
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import urllib.parse
+import importlib
 import argparse
 from datetime import datetime
 from datetime import timezone
@@ -33,26 +29,102 @@ import numpy as np
 import json
 import time
 import itertools
+import threading
+import contextlib
+from collections import namedtuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+import heapq
+import sqlite3
+import queue
+import gzip
+import zlib
 
 start_time = time.time()
 
+#
+# Heavy or rarely used dependencies are imported on first use (fast startup, importable without them)
+#
+class LazyModule:
+	def __init__(self, name):
+		self.name	= name
+		self.module	= None
+
+	def __getattr__(self, attr):
+		if (self.module == None):
+			self.module = importlib.import_module(self.name)
+
+		return getattr(self.module, attr)
+
+pd		= LazyModule("pandas")
+requests	= LazyModule("requests")
+smtplib		= LazyModule("smtplib")
+asyncio		= LazyModule("asyncio")
+
 ###################################################### CONFIG ######################################################################
 MARKETS			= ""
 
 CONFIG			= ""
 INTERVAL		= ""
+CONFIGS			= []
+INTERVALS		= []
 DEBUG			= False
 OUTPUT			= ""
+RM_VALUES		= 0
 RECHECK			= False
+RECHECK_ATTEMPTS	= 3
+RECHECK_DELAY		= 1.0
 CLOUD_ONLY		= False
 
 SMTP_SERVER		= ""
 SMTP_PORT		= ""
-SMTP_AUTH		= ""
+SMTP_AUTH		= None
+SMTP_PLAIN		= False
 RECIPIENTS		= ""
+DIGEST			= "ALL"
+NOTIFY_ATTEMPTS		= 3
+NOTIFY_DELAY		= 2.0
+
+YAHOO_URL		= "https://query1.finance.yahoo.com"
+FETCH_WORKERS		= 8
+RATE_LIMIT		= 10.0
+CACHE_DIR		= None
+ARCHIVE_DIR		= None
+BUILD_ARCHIVE		= False
+RECORD_DIR		= None
+REPLAY_DIR		= None
+REPLAY_LATENCY		= 0.0
+DETECT_CHANGES		= False
+BREADTH_FILTER		= None
+WORKERS			= 1
+BACKTEST		= None
+SWEEP			= None
+HORIZONS		= [1,5,10]
+DAEMON			= False
+DAEMON_DELAY		= 30
+DAEMON_RETRY		= 30
+DAEMON_RETRY_WINDOW	= 600
+METRICS_FILE		= None
+METRICS_FORMAT		= "JSON"
+JOURNAL_DIR		= "./journal"
+STATE_FILE		= "./ichimoku.db"
+MYTRADES_DIR		= "./MYTRADES"
+POSITIONS		= []
+
+session			= None
+limiter			= None
+source			= None
+journal			= None
+state			= None
+notifier		= None
 
 scores			= {}
 closes			= {}
+breadth			= {}
 
 ##################################################### FUNCTIONS ####################################################################
 
@@ -63,6 +135,105 @@ def myprint(str):
 	if DEBUG:
 		print(str)
 
+#
+# Wall time histograms per stage, timings per symbol & counters (shared by fetching threads)
+#
+class Metrics:
+	BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+	def __init__(self):
+		self.lock	= threading.Lock()
+		self.stages	= {}
+		self.symbols	= {}
+		self.counters	= {}
+
+	def observe(self, stage, seconds, symbol=None):
+		with self.lock:
+			# Histogram : cumulative counts per bucket (+Inf last), then sum
+			if (stage not in self.stages):
+				self.stages[stage] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+
+			histogram = self.stages[stage]
+			for i, bucket in enumerate(self.BUCKETS + [float('inf')]):
+				if (seconds <= bucket):
+					histogram[i] += 1
+			histogram[-1] += seconds
+
+			if (symbol != None):
+				timings = self.symbols.setdefault(symbol, {})
+				timings[stage] = timings.get(stage, 0.0) + seconds
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	@contextlib.contextmanager
+	def timer(self, stage, symbol=None):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(stage, time.perf_counter() - start, symbol)
+
+	# Picklable copy, used to merge metrics of worker processes
+	def snapshot(self):
+		with self.lock:
+			return {'stages': {k: list(v) for k, v in self.stages.items()}, 'symbols': {k: dict(v) for k, v in self.symbols.items()}, 'counters': dict(self.counters)}
+
+	def merge(self, snapshot):
+		with self.lock:
+			for stage, histogram in snapshot['stages'].items():
+				current = self.stages.setdefault(stage, [0] * (len(self.BUCKETS) + 1) + [0.0])
+				for i in range(0, len(histogram)):
+					current[i] += histogram[i]
+			for symbol, timings in snapshot['symbols'].items():
+				current = self.symbols.setdefault(symbol, {})
+				for stage, seconds in timings.items():
+					current[stage] = current.get(stage, 0.0) + seconds
+			for name, n in snapshot['counters'].items():
+				self.counters[name] = self.counters.get(name, 0) + n
+
+	def to_json(self):
+		snapshot = self.snapshot()
+
+		stages = {}
+		for stage, histogram in snapshot['stages'].items():
+			buckets = {str(b): n for b, n in zip(self.BUCKETS + ['+Inf'], histogram[:-1])}
+			stages[stage] = {'count': histogram[-2], 'sum': histogram[-1], 'buckets': buckets}
+
+		return json.dumps({'stages': stages, 'symbols': snapshot['symbols'], 'counters': snapshot['counters']}, indent=2)
+
+	def to_prometheus(self):
+		snapshot	= self.snapshot()
+		lines		= []
+
+		lines.append("# HELP ichimoku_stage_seconds Wall time of processing stages.")
+		lines.append("# TYPE ichimoku_stage_seconds histogram")
+		for stage, histogram in snapshot['stages'].items():
+			for b, n in zip(self.BUCKETS + ['+Inf'], histogram[:-1]):
+				lines.append('ichimoku_stage_seconds_bucket{stage="' + stage + '",le="' + str(b) + '"} ' + str(n))
+			lines.append('ichimoku_stage_seconds_sum{stage="' + stage + '"} ' + str(histogram[-1]))
+			lines.append('ichimoku_stage_seconds_count{stage="' + stage + '"} ' + str(histogram[-2]))
+
+		lines.append("# HELP ichimoku_symbol_seconds Wall time spent per symbol and stage.")
+		lines.append("# TYPE ichimoku_symbol_seconds gauge")
+		for symbol, timings in snapshot['symbols'].items():
+			for stage, seconds in timings.items():
+				lines.append('ichimoku_symbol_seconds{symbol="' + symbol + '",stage="' + stage + '"} ' + str(seconds))
+
+		for name, n in snapshot['counters'].items():
+			lines.append("# TYPE ichimoku_" + name + "_total counter")
+			lines.append("ichimoku_" + name + "_total " + str(n))
+
+		return "\n".join(lines) + "\n"
+
+	def write(self, path, fmt):
+		with open(path, 'w') as f:
+			f.write(self.to_prometheus() if (fmt == "PROMETHEUS") else self.to_json())
+
+metrics = Metrics()
+
+
 #
 # Parse args from command line
 #
@@ -71,6 +242,8 @@ def parse_args():
 
 	global CONFIG
 	global INTERVAL
+	global CONFIGS
+	global INTERVALS
 	global DEBUG
 	global OUTPUT
 	global RM_VALUES
@@ -80,8 +253,31 @@ def parse_args():
 	global SMTP_SERVER
 	global SMTP_AUTH
 	global SMTP_PORT
+	global SMTP_PLAIN
 	global RECIPIENTS
-
+	global DIGEST
+
+	global YAHOO_URL
+	global FETCH_WORKERS
+	global RATE_LIMIT
+	global CACHE_DIR
+	global ARCHIVE_DIR
+	global BUILD_ARCHIVE
+	global RECORD_DIR
+	global REPLAY_DIR
+	global REPLAY_LATENCY
+	global DETECT_CHANGES
+	global BREADTH_FILTER
+	global WORKERS
+	global BACKTEST
+	global SWEEP
+	global HORIZONS
+	global DAEMON
+	global METRICS_FILE
+	global METRICS_FORMAT
+	global JOURNAL_DIR
+	global STATE_FILE
+	global POSITIONS
 
 	example_text = '''Examples:
  		python3 ichimoku.py -m MSFT -i 15m --txt
@@ -95,27 +291,73 @@ def parse_args():
 	parser.add_argument("-m",  "--markets", type=str, help="Input string containing markets to follow (comma separated).")
 
 	# Optional args
-	parser.add_argument("-i",  "--interval", type=str, help="Interval of stock data to process. Default '1h'.", choices=['30m', '1h', '4h', '1d'], default="1h")
-	parser.add_argument("-c",  "--config", type=str, help="Ichimoku settings. Default '9,26,52'.",  choices=['9,26,52', '7,22,44'], default='9,26,52')
+	parser.add_argument("-i",  "--interval", type=str, help="Interval(s) of stock data to process among 30m, 1h, 4h, 1d (comma separated). Default '1h'.", default="1h")
+	parser.add_argument("-c",  "--config", type=str, help="Ichimoku settings (tenkan,kijun,senkou), option can be repeated. Default '9,26,52'.", action='append')
 	parser.add_argument("-d",  "--debug", help="Activate debug mode. Default 'False'.",  action='store_true', default=False)
-	parser.add_argument("-o",  "--output", help="Results output mode.",  choices=['TXT', 'EMAIL', 'HTML'], default="TXT")
+	parser.add_argument("-o",  "--output", help="Results output mode.",  choices=['TXT', 'EMAIL', 'HTML', 'JSON'], default="TXT")
 	parser.add_argument("-r",  "--remove-values", type=int, help="Number of values to be removed. Use for past analasys only. Default 0.", default=0)
-	parser.add_argument("-n",  "--check-null", help="Perform second stock request if many null values. Default 'False'.",  action='store_true', default=False)
+	parser.add_argument("-n",  "--check-null", help="Request again ranges with null values (up to 3 times, exponential backoff). Default 'False'.",  action='store_true', default=False)
+	parser.add_argument("-b",  "--backtest", type=str, help="Process scores for every bar of history and write LONG / SHORT signals with forward returns to given CSV file.")
+	parser.add_argument("--sweep", type=str, help="Rank grid of Ichimoku settings 'TENKANS:KIJUNS:SENKOUS' (each '9', '7,9' or '5-12/1') by forward returns of their signals over markets history.")
+	parser.add_argument("--horizons", type=str, help="Forward returns horizons (bars) for backtest. Default '1,5,10'.", default="1,5,10")
+	parser.add_argument("--daemon", help="Keep running and process markets again at each bar close, requesting only new bars. Default 'False'.",  action='store_true', default=False)
+	parser.add_argument("--breadth-filter", type=float, help="Minimum percent of markets above (under) cloud on last bar for LONG (SHORT) alerts. Default None (no filter).")
 	parser.add_argument("-x",  "--cloud-only", help="Process only scores for Cloud Signals (Up / Above). Default 'False'.",  action='store_true', default=False)
 
 	# Optional SMTP args
 	parser.add_argument("-s",  "--smtp-server", type=str, help="SMTP Server from which notification will be sent. Default 'smtp.gmail.com'", default='smtp.gmail.com')
 	parser.add_argument("-p",  "--smtp-port", type=int, help="SMTP Server port from which notification will be sent. Default '587'.", default=587)
 	parser.add_argument("-a",  "--smtp-auth", type=str, help="SMTP Server credentials (login:password).")
+	parser.add_argument("--smtp-plain", help="Send emails without STARTTLS, credentials in clear text (local SMTP server only). Default 'False'.",  action='store_true', default=False)
 	parser.add_argument("-t",  "--to", type=str, help="Email recipient(s) for notification ('a@a.com, b@b.com').")
+	parser.add_argument("--digest", type=str, help="Emails sent : one to all recipients, one per recipient or one per market with signals. Default 'ALL'.", choices=['ALL', 'RECIPIENT', 'MARKET'], default="ALL")
+
+	# Optional fetch args
+	parser.add_argument("--fetch-workers", type=int, help="Number of concurrent quote requests. Default 8.", default=8)
+	parser.add_argument("--rate-limit", type=float, help="Maximum requests per second sent to a host, 0 for unlimited. Default 10.", default=10.0)
+	parser.add_argument("--base-url", type=str, help="Base URL of the chart API. Default 'https://query1.finance.yahoo.com'.", default="https://query1.finance.yahoo.com")
+	parser.add_argument("--detect-changes", help="Request last market time of markets in batches first, then charts of markets which changed since last run only. Default 'False'.", action='store_true', default=False)
+	parser.add_argument("--record", type=str, help="Directory where raw chart responses are recorded (gzip JSON files). Default None.")
+	parser.add_argument("--replay", type=str, help="Directory of recorded chart responses to replay instead of requesting Yahoo Finance. Default None.")
+	parser.add_argument("--replay-latency", type=float, help="Simulated latency (seconds) of each replayed response. Default 0.", default=0.0)
+	parser.add_argument("--workers", type=int, help="Number of processes sharing markets processing. Default 1.", default=1)
+	parser.add_argument("--metrics", type=str, help="File where stages timings & counters are written at the end of run. Default None.")
+	parser.add_argument("--metrics-format", type=str, help="Metrics file format. Default 'JSON'.", choices=['JSON', 'PROMETHEUS'], default="JSON")
+	parser.add_argument("--cache-dir", type=str, help="Directory where downloaded bars are stored, only missing bars are then requested. Default None (no cache).")
+	parser.add_argument("--archive", type=str, help="Directory of bars archives (one file per interval for all markets). Markets are then read from archive instead of being requested. Default None.")
+	parser.add_argument("--build-archive", help="Request whole available history of markets (merged with cached bars), write it to archive & exit. Default 'False'.", action='store_true', default=False)
+	parser.add_argument("--state", type=str, help="SQLite file storing last alerted scores & open positions. Default './ichimoku.db'.", default="./ichimoku.db")
+	parser.add_argument("--open-position", type=str, help="Store open position 'SYMBOL:INTERVAL:LONG|SHORT' (CLOSE signals are sent for open positions only), option can be repeated.", action='append', default=[])
+	parser.add_argument("--close-position", type=str, help="Remove open position 'SYMBOL:INTERVAL:LONG|SHORT', option can be repeated.", action='append', default=[])
+	parser.add_argument("--journal", type=str, help="Directory where LONG / SHORT signals are journaled (one CSV file per month). Default './journal'.", default="./journal")
 
 	args = parser.parse_args()
 
-	INTERVAL	= args.interval
+	# Each base series is requested once for all intervals & settings
+	INTERVALS	= list(dict.fromkeys(args.interval.replace(" ", "").split(',')))
+	try:
+		CONFIGS	= list(dict.fromkeys(tuple(map(int, config.replace(" ", "").split(','))) for config in (args.config or ['9,26,52'])))
+		SWEEP	= sweep_grid(args.sweep) if (args.sweep != None) else None
+	except ValueError:
+		print("ERROR: Ichimoku settings should be integers 'TENKAN,KIJUN,SENKOU' (sweep grid 'TENKANS:KIJUNS:SENKOUS').")
+		sys.exit(0)
+
+	for config in CONFIGS + (SWEEP or []):
+		if (len(config) != 3) or not (0 < config[0] < config[1] < config[2]):
+			print("ERROR: Ichimoku settings '" + ",".join(map(str, config)) + "' should be increasing periods (tenkan < kijun < senkou).")
+			sys.exit(0)
+
+	if (SWEEP != None) and (len(SWEEP) == 0):
+		print("ERROR: Sweep grid '" + args.sweep + "' has no valid settings (tenkan < kijun < senkou).")
+		sys.exit(0)
+
+	for ntvl in INTERVALS:
+		if (ntvl not in ['30m', '1h', '4h', '1d']):
+			print("ERROR: Interval '" + ntvl + "' not supported.")
+			sys.exit(0)
 
-	CONFIG		= args.config.replace(" ", "").split(',')
-	mp		= map(int, CONFIG)
-	CONFIG 		= list(mp)
+	INTERVAL	= INTERVALS[0]
+	CONFIG		= CONFIGS[0]
 
 	DEBUG		= args.debug
 	OUTPUT		= args.output
@@ -124,11 +366,59 @@ def parse_args():
 	CLOUD_ONLY	= args.cloud_only
 
 	RECIPIENTS	= args.to
+	DIGEST		= args.digest
 	SMTP_SERVER	= args.smtp_server
 	SMTP_PORT	= args.smtp_port
+	SMTP_PLAIN	= args.smtp_plain
+
+	YAHOO_URL	= args.base_url.rstrip('/')
+	FETCH_WORKERS	= max(1, args.fetch_workers)
+	RATE_LIMIT	= args.rate_limit
+	CACHE_DIR	= args.cache_dir
+	ARCHIVE_DIR	= args.archive
+	BUILD_ARCHIVE	= args.build_archive
+	RECORD_DIR	= args.record
+	REPLAY_DIR	= args.replay
+	REPLAY_LATENCY	= args.replay_latency
+	DETECT_CHANGES	= args.detect_changes
+	BREADTH_FILTER	= args.breadth_filter
+	WORKERS		= max(1, args.workers)
+	BACKTEST	= args.backtest
+	DAEMON		= args.daemon
+	METRICS_FILE	= args.metrics
+	METRICS_FORMAT	= args.metrics_format
+	JOURNAL_DIR	= args.journal
+	STATE_FILE	= args.state
+	HORIZONS	= list(map(int, args.horizons.replace(" ", "").split(',')))
+
+	if (CACHE_DIR != None):
+		os.makedirs(CACHE_DIR, exist_ok=True)
+
+	if (RECORD_DIR != None):
+		os.makedirs(RECORD_DIR, exist_ok=True)
+
+	if (REPLAY_DIR != None) and not os.path.isdir(REPLAY_DIR):
+		print("ERROR: Replay directory '" + REPLAY_DIR + "' not found.")
+		sys.exit(0)
+
+	if BUILD_ARCHIVE and (ARCHIVE_DIR == None):
+		print("ERROR: Archive directory should be provided (--archive) to build archive.")
+		sys.exit(0)
+
+	POSITIONS = []
+	for action, positions in [("open", args.open_position), ("close", args.close_position)]:
+		for position in positions:
+			position = position.replace(" ", "").split(":")
+			if (len(position) != 3) or (position[1] not in ['30m', '1h', '4h', '1d']) or (position[2].upper() not in ['LONG', 'SHORT']):
+				print("ERROR: Position '" + ":".join(position) + "' should be 'SYMBOL:INTERVAL:LONG|SHORT'.")
+				sys.exit(0)
+			POSITIONS.append((action, position[0].replace(".","_").replace("-","_").replace("/","_"), position[1], position[2].upper()))
 
 	if (args.smtp_auth != None) :
-		SMTP_AUTH	= args.smtp_auth.split(":")
+		SMTP_AUTH	= args.smtp_auth.split(":", 1)
+		if (len(SMTP_AUTH) != 2) or (SMTP_AUTH[0] == ""):
+			print("ERROR: SMTP credentials should be 'login:password'.")
+			sys.exit(0)
 
 	if (args.markets_file == None) and (args.markets == None):
 		print("ERROR: At least one market or file should be provided as argument. ")
@@ -144,7 +434,8 @@ def parse_args():
 	else:
 		MARKETS = args.markets.replace(' ', '').split(",")
 
-	if (OUTPUT == "EMAIL") and ((RECIPIENTS == None) or (SMTP_SERVER == None) or (SMTP_AUTH == None)) :
+	# Credentials are required, except for a local SMTP server (plain text)
+	if (OUTPUT == "EMAIL") and ((RECIPIENTS == None) or (SMTP_SERVER == None) or ((SMTP_AUTH == None) and not SMTP_PLAIN)) :
 		myprint("WARNING: MAIL output specified but no SMTP information provided and / or recipients. Defaulting to TXT output")
 		OUTPUT = "TXT"
 
@@ -154,9 +445,121 @@ def parse_args():
 
 
 #
-# Retrieve data from Yahoo Finance & return DataFrame
+# Settings needed to process markets, passed explicitly to worker processes
+#
+Settings = namedtuple('Settings', ['configs', 'intervals', 'debug', 'output', 'rm_values', 'recheck', 'cloud_only', 'yahoo_url', 'fetch_workers', 'rate_limit', 'cache_dir', 'archive_dir', 'record_dir', 'replay_dir', 'replay_latency'])
+
+def current_settings():
+	return Settings(tuple(CONFIGS), tuple(INTERVALS), DEBUG, OUTPUT, RM_VALUES, RECHECK, CLOUD_ONLY, YAHOO_URL, FETCH_WORKERS, RATE_LIMIT, CACHE_DIR, ARCHIVE_DIR, RECORD_DIR, REPLAY_DIR, REPLAY_LATENCY)
+
+
+#
+# Apply settings : HTTP session, rate limiter & data source are created again with them
+#
+def apply_settings(settings):
+	global session
+	global limiter
+	global source
+	global CONFIG
+	global INTERVAL
+	global CONFIGS
+	global INTERVALS
+	global DEBUG
+	global OUTPUT
+	global RM_VALUES
+	global RECHECK
+	global CLOUD_ONLY
+	global YAHOO_URL
+	global FETCH_WORKERS
+	global RATE_LIMIT
+	global CACHE_DIR
+	global ARCHIVE_DIR
+	global RECORD_DIR
+	global REPLAY_DIR
+	global REPLAY_LATENCY
+
+	CONFIGS		= list(settings.configs)
+	INTERVALS	= list(settings.intervals)
+	CONFIG		= CONFIGS[0]
+	INTERVAL	= INTERVALS[0]
+	DEBUG		= settings.debug
+	OUTPUT		= settings.output
+	RM_VALUES	= settings.rm_values
+	RECHECK		= settings.recheck
+	CLOUD_ONLY	= settings.cloud_only
+	YAHOO_URL	= settings.yahoo_url
+	FETCH_WORKERS	= settings.fetch_workers
+	RATE_LIMIT	= settings.rate_limit
+	CACHE_DIR	= settings.cache_dir
+	ARCHIVE_DIR	= settings.archive_dir
+	RECORD_DIR	= settings.record_dir
+	REPLAY_DIR	= settings.replay_dir
+	REPLAY_LATENCY	= settings.replay_latency
+
+	session	= None
+	limiter	= None
+	source	= None
+
+
+#
+# Limit number of requests sent per second to each host (shared by fetching threads)
+#
+class RateLimiter:
+	def __init__(self, rate):
+		self.interval	= 1.0 / rate if (rate > 0) else 0.0
+		self.slots	= {}
+		self.lock	= threading.Lock()
+
+	def wait(self, host):
+		if (self.interval == 0):
+			return
+
+		with self.lock:
+			now  = time.monotonic()
+			slot = max(now, self.slots.get(host, now))
+			self.slots[host] = slot + self.interval
+
+		if (slot > now):
+			time.sleep(slot - now)
+
+
+#
+# Return HTTP session shared by all requests (keep-alive connection pool)
+#
+def get_session():
+	global session
+	global limiter
+
+	if (session == None):
+		adapter = requests.adapters.HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+
+		session = requests.Session()
+		session.headers.update({'User-Agent': ''})
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+
+		limiter = RateLimiter(RATE_LIMIT)
+
+	return session
+
+
+INTERVAL_SECONDS = {'30m': 1800, '1h': 3600, '1d': 86400}
+
+#
+# Intervals grouped by Yahoo interval to request (4h is built from 1h)
 #
-def get_quote_data(symbol, ntvl, iteration):
+def interval_groups(intervals):
+	groups = {}
+	for ntvl in intervals:
+		groups.setdefault(chart_params(ntvl)[0], []).append(ntvl)
+
+	return groups
+
+
+#
+# Yahoo interval & range to request for an interval (4h is built from 1h)
+#
+def chart_params(ntvl):
 	rng = "2y"
 
 	if (ntvl == "30m"):
@@ -167,543 +570,2338 @@ def get_quote_data(symbol, ntvl, iteration):
 		ntvl = "1h"
 		rng  = "4mo"
 
-	headers = {
-		'User-Agent': ''
-	}
+	return ntvl, rng
 
-	res = requests.get('https://query1.finance.yahoo.com/v8/finance/chart/' + symbol + '?range=' + rng + '&interval=' + ntvl, headers=headers)
-	data = res.json()
 
-	myprint('GET QUOTE DATA : https://query1.finance.yahoo.com/v8/finance/chart/' + symbol + '?range=' + rng + '&interval=' + ntvl)
+#
+# Retrieve raw chart JSON from Yahoo Finance (through bars cache if enabled)
+#
+def fetch_chart(symbol, ntvl):
+	ntvl, rng = chart_params(ntvl)
 
-	if (data['chart']['result'] == None):
-		myprint("ERROR: Market unknown! Passing...")
-		return None
+	if (CACHE_DIR != None):
+		return fetch_cached_chart(symbol, ntvl, rng)
 
-	body = data['chart']['result'][0]
-	df = pd.DataFrame(body['indicators']['quote'][0])
+	return request_chart(symbol, '?range=' + rng + '&interval=' + ntvl)
 
-	df['timestamp'] 	= body['timestamp']
 
-	df['timezone']		= body['meta']['exchangeTimezoneName']
-	df['exchange']		= body['meta']['exchangeName']
+#
+# Data sources : raw chart response (JSON bytes) of a symbol & query.
+# Yahoo Finance (live), recording of another source, or replay of recorded responses.
+#
+class YahooSource:
+	def chart(self, symbol, query):
+		url = YAHOO_URL + '/v8/finance/chart/' + symbol + query
+		myprint('GET QUOTE DATA : ' + url)
 
-	df['KIJUNSEN'] 		= 0.0
-	df['TENKANSEN'] 	= 0.0
-	df['SSA']		= 0.0
-	df['SSB'] 		= 0.0
+		s = get_session()
+		limiter.wait(urllib.parse.urlsplit(url).netloc)
 
-	df['SIGNAL_X_PRC_CLD']	= 0
-	df['SIGNAL_X_CHI_KIJ']	= 0
-	df['SIGNAL_X_KIJ_TEN']	= 0
-	df['SIGNAL_X_KIJ_PRC']	= 0
-	df['SIGNAL_X_CHI_PRC']	= 0
-	df['SIGNAL_X_CHI_SSB']	= 0
+		metrics.count("requests")
 
-	df['SIGNAL_PRC_CLD']	= 0
-	df['SIGNAL_CHI_KIJ']	= 0
-	df['SIGNAL_KIJ_TEN']	= 0
-	df['SIGNAL_KIJ_PRC']	= 0
-	df['SIGNAL_CHI_PRC']	= 0
-	df['SIGNAL_CHI_SSB']	= 0
+		return s.get(url, timeout=30).content
 
-	df['SIGNAL_RATIO_LONG']		= 0
-	df['SIGNAL_RATIO_SHORT']	= 0
+	def spark(self, symbols, query):
+		url = YAHOO_URL + '/v7/finance/spark?symbols=' + ",".join(symbols) + query
+		myprint('GET SPARK DATA : ' + url)
 
-	pd.options.mode.chained_assignment = None
-	pd.set_option('display.max_rows', None)
+		s = get_session()
+		limiter.wait(urllib.parse.urlsplit(url).netloc)
 
-	# Checking for Null / Error values, excluding weekends
-	for i in range (df.index[0], df.index[-1] + 1):
-		if np.isnan(df['open'][i]) and (datetime.fromtimestamp(df['timestamp'][i]).weekday() < 6):
-			if RECHECK:
-				if (iteration <= 1):
-					time.sleep(1)
-					myprint("WARNING: Market has too many Null values for processing. Trying again...")
-					df = get_quote_data(symbol, ntvl, iteration + 1)
-					break
-				else:
-					myprint("WARNING: Market has too many Null values for processing. Maybe errors...")
-					break
-			else:
-				myprint("WARNING: Market has too many Null values for processing. Maybe errors...")
-				break
+		metrics.count("spark_requests")
 
+		return s.get(url, timeout=30).content
 
-	if (iteration <=1 ):
-		if (df['volume'][df.index[-1]] == 0):
-			df = df[:-1]
 
-		for i in range (0,RM_VALUES):
-			df = df[:-1]
+#
+# File name of a recorded response (end of requested period is ignored, as it is the request time)
+#
+def record_key(symbol, query):
+	params = sorted((k, v) for k, v in urllib.parse.parse_qsl(query.lstrip('?')) if (k != 'period2'))
 
-		df = df[-500:]
-		df.dropna(inplace=True)
-		df.reset_index(drop=True, inplace=True)
+	return symbol.replace("/", "_") + "".join("_" + k + "-" + v for k, v in params) + ".json.gz"
 
-		if (len(df) <= int(CONFIG[2] * 1.5)):
-			myprint("ERROR: Market has too few history for Ichimoku! Passing...")
-			return None
 
-	return df
+#
+# File name of a recorded spark response (symbols list is hashed)
+#
+def spark_key(symbols, query):
+	return record_key("spark_" + format(zlib.crc32(",".join(symbols).encode()), '08x'), query)
+
+
+class RecordingSource:
+	def __init__(self, source, path):
+		self.source	= source
+		self.path	= path
 
+	def chart(self, symbol, query):
+		return self.record(self.source.chart(symbol, query), record_key(symbol, query))
+
+	def spark(self, symbols, query):
+		return self.record(self.source.spark(symbols, query), spark_key(symbols, query))
+
+	def record(self, content, key):
+		path	= os.path.join(self.path, key)
+		tmp	= path + "." + str(os.getpid()) + "_" + str(threading.get_ident()) + ".tmp"
+
+		with gzip.open(tmp, 'wb') as f:
+			f.write(content)
+		os.replace(tmp, path)
+
+		return content
+
+
+class ReplaySource:
+	def __init__(self, path, latency=0.0):
+		self.path	= path
+		self.latency	= latency
+
+	def chart(self, symbol, query):
+		myprint('REPLAY QUOTE DATA : ' + symbol + query)
+
+		return self.replay(record_key(symbol, query))
+
+	def spark(self, symbols, query):
+		myprint('REPLAY SPARK DATA : ' + ",".join(symbols) + query)
+
+		return self.replay(spark_key(symbols, query))
+
+	def replay(self, key):
+		if (self.latency > 0):
+			time.sleep(self.latency)
+
+		metrics.count("replays")
+
+		with gzip.open(os.path.join(self.path, key), 'rb') as f:
+			return f.read()
 
 
 #
-# Transform a 1h dataframe into a 4h (Yahoo does not provide 4h's one)
+# Return data source of the run (replay, recording or live)
 #
-def transform_four_hours(df):
-	myprint("ENTERING H4 PROCESSING...")
+def get_source():
+	global source
 
-	df_size = 130
+	if (source == None):
+		if (REPLAY_DIR != None):
+			source = ReplaySource(REPLAY_DIR, REPLAY_LATENCY)
+		else:
+			source = YahooSource()
+			if (RECORD_DIR != None):
+				source = RecordingSource(source, RECORD_DIR)
 
-	# Sequences for candle transformation (depends on markets)
-	eu_sequence = [4,4,1]
-	us_sequence = [3,4]
-	#cr_sequence = [4,4,4,4,4,4]
-	#mp_sequence = [4,4,4,4,4,4]
+	return source
 
-	sequence = ""
 
-	if (df['timezone'][0].split('/')[0] == "Europe"):
-		sequence = eu_sequence
+#
+# Send chart request to data source & return JSON
+#
+def request_chart(symbol, query):
+	try:
+		with metrics.timer("fetch", symbol):
+			content = get_source().chart(symbol, query)
+		with metrics.timer("decode", symbol):
+			return json.loads(content)
+	except (OSError, ValueError) as e:
+		myprint("ERROR: Request failed for " + symbol + " (" + str(e) + ")")
+		metrics.count("request_errors")
+		return None
 
-	if (df['timezone'][0].split('/')[0] == "America") and (df['exchange'][0] != "CMX"):
-		sequence = us_sequence
 
-	if (sequence == ""):
-		myprint("ERROR: Stock market not supported yet for H4 Ichimoku, PASSING.")
+#
+# Send spark request (last market time of several symbols) to data source & return JSON
+#
+def request_spark(symbols):
+	try:
+		with metrics.timer("spark"):
+			return json.loads(get_source().spark(symbols, '&range=1d&interval=1d'))
+	except (OSError, ValueError) as e:
+		myprint("ERROR: Spark request failed for " + ",".join(symbols) + " (" + str(e) + ")")
+		metrics.count("request_errors")
 		return None
 
-	dt = datetime.today()
-	dt = datetime(dt.year, dt.month, dt.day)
-	timestamp = dt.replace(tzinfo=timezone.utc).timestamp()
 
-	today_candle = 0
-	for i in range (len(df) - 15, len(df)):
-		if (df['timestamp'][i] >= timestamp):
-			today_candle += 1
+#
+# Batched change detection : last market time of symbols, requested by chunks of symbols
+#
+SPARK_CHUNK = 20
 
-	start_sequence	= 0
-	start_candle 	= df.index[-1]
+def market_times(symbols):
+	get_session()
 
-	# Process : How many candle do we have a remove at the end for correct H4 ?
-	start_sequence = 0
-	for i in range (0, len(sequence)):
-		if today_candle >= np.sum(sequence[i:len(sequence)]):
-			start_sequence = i
-			start_candle = start_candle - (today_candle - np.sum(sequence[i:len(sequence)]))
-			break
+	times	= {}
+	chunks	= [symbols[i:i + SPARK_CHUNK] for i in range(0, len(symbols), SPARK_CHUNK)]
 
-	avg_candle = np.sum(sequence) / len(sequence)
+	with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+		for data in executor.map(request_spark, chunks):
+			if (data == None) or (data.get('spark') == None):
+				continue
 
-	# Insure we have sufficient values to trasnform H1 data to H4 data (80 rows min for ichimoku)
-	if ((len(df) / avg_candle) <= df_size):
-		myprint("ERROR: Market has too few history for H4 ichimoku! Passing...")
-		return None
+			for result in (data['spark'].get('result') or []):
+				response = result.get('response') or [{}]
+				if ('regularMarketTime' in response[0].get('meta', {})):
+					times[result['symbol']] = response[0]['meta']['regularMarketTime']
 
-	df4 = pd.DataFrame(columns=list(df.columns), index=[x for x in range(0, df_size)])
-
-	df4['timezone']		= df['timezone'][0]
-	df4['exchange']		= df['exchange'][0]
-
-	df4['KIJUNSEN'] 	= 0.0
-	df4['TENKANSEN'] 	= 0.0
-	df4['SSA']		= 0.0
-	df4['SSB'] 		= 0.0
-
-	df4['SIGNAL_X_PRC_CLD']	= 0
-	df4['SIGNAL_X_CHI_KIJ']	= 0
-	df4['SIGNAL_X_KIJ_TEN']	= 0
-	df4['SIGNAL_X_KIJ_PRC']	= 0
-	df4['SIGNAL_X_CHI_PRC']	= 0
-	df4['SIGNAL_X_CHI_SSB']	= 0
-
-	df4['SIGNAL_PRC_CLD']	= 0
-	df4['SIGNAL_CHI_KIJ']	= 0
-	df4['SIGNAL_KIJ_TEN']	= 0
-	df4['SIGNAL_KIJ_PRC']	= 0
-	df4['SIGNAL_CHI_PRC']	= 0
-	df4['SIGNAL_CHI_SSB']	= 0
-
-	df4['SIGNAL_RATIO_LONG']	= 0
-	df4['SIGNAL_RATIO_SHORT']	= 0
-
-	cpt1 = start_candle
-	cpt2 = 1
-	while (df_size-cpt2 >= 0):
-		for i in range (0, len(sequence)):
-			if (i >= start_sequence):
-				s = sequence[i]
-				if sequence[i] > 1 :
-					df4['low'][df_size-cpt2]         =  np.min(df['low'][cpt1-s+1:cpt1+1])
-					df4['high'][df_size-cpt2]        =  np.max(df['high'][cpt1-s+1:cpt1+1])
-					df4['volume'][df_size-cpt2]      =  np.sum(df['volume'][cpt1-s+1:cpt1+1])
-					df4['open'][df_size-cpt2]        =  df['open'][cpt1-s+1]
-					df4['close'][df_size-cpt2]       =  df['close'][cpt1]
-					df4['timestamp'][df_size-cpt2]   =  df['timestamp'][cpt1-s+1]
-				else:
-					df4['low'][df_size-cpt2]         =  df['low'][cpt1]
-					df4['high'][df_size-cpt2]        =  df['high'][cpt1]
-					df4['volume'][df_size-cpt2]      =  df['volume'][cpt1]
-					df4['open'][df_size-cpt2]        =  df['open'][cpt1]
-					df4['close'][df_size-cpt2]       =  df['close'][cpt1]
-					df4['timestamp'][df_size-cpt2]   =  df['timestamp'][cpt1]
-
-
-				cpt1 -= s
-				cpt2 += 1
-		start_sequence = 0
-
-	for i in range (0,RM_VALUES):
-		df4 = df4[:-1]
+	return times
 
-	return df4
 
 #
-# Sends Email to recipients
+# Markets whose market time changed since last run (or unknown), with market times
 #
-def send_email(msg):
-	myprint("SENDING EMAIL...")
+def changed_markets(symbols):
+	times	= market_times(symbols)
+	changed	= [symbol for symbol in symbols if (symbol not in times) or any(get_state().market_time(symbol, interval) != times[symbol] for interval in INTERVALS)]
 
-	sender = "Trading Server"
+	myprint("CHANGES: " + str(len(changed)) + " / " + str(len(symbols)) + " markets changed since last run")
+	metrics.count("unchanged", len(symbols) - len(changed))
 
-	message = MIMEMultipart("alternative")
-	message["Subject"] = "Trading Opportunities (" +  datetime.now().strftime('%d/%m %H:%M')  + ") !"
-	message["From"] = "Trading Server"
-	message["To"] = RECIPIENTS
+	return changed, times
 
-	message.attach(MIMEText(msg,"html"))
 
-	server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-	server.ehlo()
-	server.starttls()
-	server.ehlo()
-	server.login(SMTP_AUTH[0], SMTP_AUTH[1])
-	server.sendmail( sender, RECIPIENTS, message.as_string() )
+#
+# Bars cache : one memory-mapped .npy file (and a .json file for market metadata) per symbol & interval
+#
+BAR_DTYPE = np.dtype([('timestamp', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'), ('volume', '<f8')])
+
+def cache_path(symbol, ntvl):
+	return os.path.join(CACHE_DIR, symbol.replace("/", "_") + "_" + ntvl)
 
 
 #
-# Process Ichimoku Cloud data from received Yahoo DataFrame
+# Load cached bars & metadata, (None, None) if symbol was never cached
 #
-def processIchimoku(df):
-	# NOT IMPORTANT PROCESSING ALL DATA, ONLY FEW WINDOWS NECESSARY
-	for i in range (df.index[-1] - 8, df.index[-1] + 1 ):
-		# KIJUN SEN & TENKAN SEN
-		df['KIJUNSEN'][i]		= (np.max(df['high'][i-(CONFIG[1]-1):i+1]) + np.min(df['low'][i-(CONFIG[1]-1):i+1]) ) / 2
-		df['TENKANSEN'][i]		= (np.max(df['high'][i-(CONFIG[0]-1):i+1]) + np.min(df['low'][i-(CONFIG[0]-1):i+1]) ) / 2
+def load_bars(symbol, ntvl):
+	path = cache_path(symbol, ntvl)
 
-		df['KIJUNSEN'][i-CONFIG[1]]	= (np.max(df['high'][(i-CONFIG[1])-(CONFIG[1]-1):i-CONFIG[1]+1]) + np.min(df['low'][(i-CONFIG[1])-(CONFIG[1]-1):i-CONFIG[1]+1]) ) / 2
-		df['TENKANSEN'][i-CONFIG[1]]	= (np.max(df['high'][(i-CONFIG[1])-(CONFIG[0]-1):i-CONFIG[1]+1]) + np.min(df['low'][(i-CONFIG[1])-(CONFIG[0]-1):i-CONFIG[1]+1]) ) / 2
+	if not (os.path.isfile(path + ".npy") and os.path.isfile(path + ".json")):
+		return None, None
 
-		df['KIJUNSEN'][i-CONFIG[1]-CONFIG[1]]	= (np.max(df['high'][(i-CONFIG[1]-CONFIG[1])-(CONFIG[1]-1):i-CONFIG[1]-CONFIG[1]+1]) + np.min(df['low'][(i-CONFIG[1]-CONFIG[1])-(CONFIG[1]-1):i-CONFIG[1]-CONFIG[1]+1]) ) / 2
-		df['TENKANSEN'][i-CONFIG[1]-CONFIG[1]]	= (np.max(df['high'][(i-CONFIG[1]-CONFIG[1])-(CONFIG[0]-1):i-CONFIG[1]-CONFIG[1]+1]) + np.min(df['low'][(i-CONFIG[1]-CONFIG[1])-(CONFIG[0]-1):i-CONFIG[1]-CONFIG[1]+1]) ) / 2
+	try:
+		with open(path + ".json") as f:
+			meta = json.load(f)
+		bars = np.load(path + ".npy", mmap_mode='r')
+	except (OSError, ValueError) as e:
+		myprint("WARNING: Cache unreadable for " + symbol + " (" + str(e) + ")")
+		return None, None
 
-		# SSA & SSB
-		df['SSA'][i-CONFIG[1]] 	= (df['KIJUNSEN'][i-CONFIG[1]-CONFIG[1]] + df['TENKANSEN'][i-CONFIG[1]-CONFIG[1]]) / 2
-		df['SSB'][i-CONFIG[1]] 	= (np.max(df['high'][(i-CONFIG[1]-CONFIG[1])-(CONFIG[2]-1):(i-CONFIG[1]-CONFIG[1]+1)])  + np.min(df['low'][(i-CONFIG[1]-CONFIG[1])-(CONFIG[2]-1):(i-CONFIG[1]-CONFIG[1]+1)])  ) / 2
+	return bars, meta
 
-		df['SSA'][i] = (df['KIJUNSEN'][i-CONFIG[1]] + df['TENKANSEN'][i-CONFIG[1]]) / 2
-		df['SSB'][i] = (np.max(df['high'][(i-CONFIG[1])-(CONFIG[2]-1):(i-CONFIG[1])+1])  + np.min(df['low'][(i-CONFIG[1])-(CONFIG[2]-1):(i-CONFIG[1])+1])  ) / 2
 
+#
+# Store bars & metadata (written to temporary files first, then renamed)
+#
+def save_bars(symbol, ntvl, bars, meta):
+	path = cache_path(symbol, ntvl)
+	tmp  = path + "." + str(os.getpid()) + "_" + str(threading.get_ident()) + ".tmp"
 
-	for i in range (df.index[-1] - 7, df.index[-1] + 1):
-		# Are we in a bearish trend (SELL)
-		if ( (df['close'][i] < df['SSA'][i]) and (df['close'][i] < df['SSB'][i]) ):
-			if ( (df['open'][i] < df['SSA'][i]) or (df['open'][i] < df['SSB'][i]) ):
-				df['SIGNAL_PRC_CLD'][i] = -1
+	with open(tmp + ".npy", 'wb') as f:
+		np.save(f, bars)
+	with open(tmp + ".json", 'w') as f:
+		json.dump(meta, f)
 
-		# Are we in a bullish trend (BUY)
-		if ( (df['close'][i] > df['SSA'][i]) and (df['close'][i] > df['SSB'][i]) ):
-			if ( (df['open'][i] > df['SSA'][i]) or (df['open'][i] > df['SSB'][i]) ):
-				df['SIGNAL_PRC_CLD'][i] = 1
+	os.replace(tmp + ".npy", path + ".npy")
+	os.replace(tmp + ".json", path + ".json")
 
-		# Do we have a cloud buying signal (price going above cloud) ?
-		if ( (df['SIGNAL_PRC_CLD'][i] == 1 ) and (df['SIGNAL_PRC_CLD'][i-1] != 1 ) ):
-			df['SIGNAL_X_PRC_CLD'][i] = 1
 
-		# Do we have a cloud selling signal (price going under cloud) ?
-		if ( (df['SIGNAL_PRC_CLD'][i] == -1 ) and (df['SIGNAL_PRC_CLD'][i-1] != -1 ) ):
-			df['SIGNAL_X_PRC_CLD'][i] = -1
+#
+# Convert Yahoo chart result to bars array (null values become NaN)
+#
+def body_to_bars(body):
+	timestamps = body.get('timestamp', [])
+	quote      = body['indicators']['quote'][0]
 
-		# Is Chikou crossing Kijun ?
-		if ((df['close'][i-1] <= df['KIJUNSEN'][i-(CONFIG[1]+1)]) and (df['close'][i] >= df['KIJUNSEN'][i-CONFIG[1]]) ):  df['SIGNAL_X_CHI_KIJ'][i] = 1
-		if ((df['close'][i-1] >= df['KIJUNSEN'][i-(CONFIG[1]+1)]) and (df['close'][i] <= df['KIJUNSEN'][i-CONFIG[1]]) ):  df['SIGNAL_X_CHI_KIJ'][i] = -1
+	bars = np.zeros(len(timestamps), dtype=BAR_DTYPE)
+	bars['timestamp'] = timestamps
+	for name in BAR_DTYPE.names[1:]:
+		values = quote.get(name)
+		bars[name] = np.nan if values is None else np.array(values, dtype=float)
 
-		# Is Kijun crossing Tenkan ?
-		if (df['KIJUNSEN'][i-1] >= df['TENKANSEN'][i-1]) and (df['KIJUNSEN'][i] <  df['TENKANSEN'][i]): df['SIGNAL_X_KIJ_TEN'][i] = 1
-		if (df['KIJUNSEN'][i-1] <= df['TENKANSEN'][i-1]) and (df['KIJUNSEN'][i] >  df['TENKANSEN'][i]): df['SIGNAL_X_KIJ_TEN'][i] = -1
+	return bars
 
-		# Is Kijun crossing Price ?
-		if (df['KIJUNSEN'][i-1] >= df['close'][i-1] and df['KIJUNSEN'][i] <= df['close'][i]):	df['SIGNAL_X_KIJ_PRC'][i] = 1
-		if (df['KIJUNSEN'][i-1] <= df['close'][i-1] and df['KIJUNSEN'][i] >= df['close'][i]):	df['SIGNAL_X_KIJ_PRC'][i] = -1
 
-		# Is Chikou crossing SSB ?
-		if (df['SSB'][i-(CONFIG[1]+1)] >= df['close'][i-1]) and (df['SSB'][i-CONFIG[1]] < df['close'][i]) : df['SIGNAL_X_CHI_SSB'][i] = 1
-		if (df['SSB'][i-(CONFIG[1]+1)] <= df['close'][i-1]) and (df['SSB'][i-CONFIG[1]] > df['close'][i]) : df['SIGNAL_X_CHI_SSB'][i] = -1
+#
+# Convert bars array & metadata to Yahoo chart JSON
+#
+def bars_to_chart(bars, meta):
+	quote = {}
+	for name in BAR_DTYPE.names[1:]:
+		quote[name] = bars[name]
 
-		# Is Chikou crossing Price ?
-		if (df['close'][i-(CONFIG[1]+1)] >= df['close'][i-1]) and (df['close'][i-CONFIG[1]] < df['close'][i]) : df['SIGNAL_X_CHI_PRC'][i] = 1
-		if (df['close'][i-(CONFIG[1]+1)] <= df['close'][i-1]) and (df['close'][i-CONFIG[1]] > df['close'][i]) : df['SIGNAL_X_CHI_PRC'][i] = -1
+	return {'chart': {'result': [{'meta': meta, 'timestamp': bars['timestamp'], 'indicators': {'quote': [quote]}}], 'error': None}}
 
 
-		# Is Price under of above Kijun ?
-		if (df['KIJUNSEN'][i] < df['close'][i]):	df['SIGNAL_KIJ_PRC'][i] = 1
-		if (df['KIJUNSEN'][i] > df['close'][i]):	df['SIGNAL_KIJ_PRC'][i] = -1
+#
+# Replace cached bars from first new bar onwards with new bars
+#
+def merge_bars(bars, new):
+	if (len(new) == 0):
+		return np.array(bars)
 
-		# Is Chikou under or above Price ?
-		if (df['close'][i] > df['close'][i-CONFIG[1]]):	df['SIGNAL_CHI_PRC'][i] = 1
-		if (df['close'][i] < df['close'][i-CONFIG[1]]):	df['SIGNAL_CHI_PRC'][i] = -1
+	return np.concatenate([bars[bars['timestamp'] < new['timestamp'][0]], new])
 
-		# Is Chikou under or above Kijun ?
-		if (df['close'][i] > df['KIJUNSEN'][i-CONFIG[1]]):  df['SIGNAL_CHI_KIJ'][i] = 1
-		if (df['close'][i] < df['KIJUNSEN'][i-CONFIG[1]]):  df['SIGNAL_CHI_KIJ'][i] = -1
 
-		# Is Kijun under or above Tenkan ?
-		if (df['KIJUNSEN'][i] > df['TENKANSEN'][i]):  df['SIGNAL_KIJ_TEN'][i] = -1
-		if (df['KIJUNSEN'][i] < df['TENKANSEN'][i]):  df['SIGNAL_KIJ_TEN'][i] = 1
+#
+# Request bars from the last known one onwards (it may have been incomplete), or from the first recent null one,
+# & merge them with known bars
+#
+TAIL_LOOKBACK = 30 * 86400
 
-		# Is Chikou under or above SSB ?
-		if (df['close'][i] > df['SSB'][i-CONFIG[1]]):  df['SIGNAL_CHI_SSB'][i] = 1
-		if (df['close'][i] < df['SSB'][i-CONFIG[1]]):  df['SIGNAL_CHI_SSB'][i] = -1
+def request_tail(symbol, ntvl, bars, meta):
+	period1 = int(bars['timestamp'][-1])
 
-		# Processing percent of SHORT and LONG signals
-		nodes = {}
-		nodes['A'] = df['SIGNAL_PRC_CLD'][i]
-		nodes['B'] = df['SIGNAL_KIJ_PRC'][i]
-		nodes['C'] = df['SIGNAL_CHI_PRC'][i]
-		nodes['D'] = df['SIGNAL_CHI_KIJ'][i]
-		nodes['E'] = df['SIGNAL_KIJ_TEN'][i]
-		nodes['F'] = df['SIGNAL_CHI_SSB'][i]
+	# Null bars of the last TAIL_LOOKBACK seconds are requested again (Yahoo may have filled them since)
+	recent	= bars[bars['timestamp'] >= period1 - TAIL_LOOKBACK]
+	nulls	= recent['timestamp'][null_values(recent['timestamp'], recent['open'], meta.get('gmtoffset', 0))]
+	if (len(nulls) > 0):
+		period1 = int(nulls[0])
 
-		for node in nodes:
-			if (nodes[node] == 1):
-				df['SIGNAL_RATIO_LONG'][i] = df['SIGNAL_RATIO_LONG'][i] + 1
-			if (nodes[node] == -1):
-				df['SIGNAL_RATIO_SHORT'][i] = df['SIGNAL_RATIO_SHORT'][i] - 1
+	query = '?period1=' + str(period1) + '&period2=' + str(int(time.time())) + '&interval=' + ntvl
+	data  = request_chart(symbol, query)
 
-		df['SIGNAL_RATIO_LONG'][i] = df['SIGNAL_RATIO_LONG'][i] * 100 / 6
-		df['SIGNAL_RATIO_SHORT'][i] = df['SIGNAL_RATIO_SHORT'][i] * 100 / 6
+	if (data == None) or (data['chart']['result'] == None):
+		return None, None
+
+	body = data['chart']['result'][0]
+
+	return merge_bars(bars, body_to_bars(body)), body['meta']
 
-	return df
 
 #
-# Process score for DataFrame
+# Keep only bars of the requested range (& a margin) before last bar, so that cache does not grow without bound
 #
-def process_score(df):
-	myprint("PROCESSING SCORE...")
+CACHE_MARGIN = 7 * 86400
 
-	# Processing scores for each symbol
-	nodes 		= {}
-	histo_scores	= [0,0]
-	cloud_signal	= False
-
-	nodes['A'] = df['SIGNAL_X_PRC_CLD'][df.index[-1]]
-	nodes['B'] = df['SIGNAL_X_KIJ_PRC'][df.index[-1]]
-	nodes['C'] = df['SIGNAL_X_CHI_PRC'][df.index[-1]]
-	nodes['D'] = df['SIGNAL_X_CHI_KIJ'][df.index[-1]]
-	nodes['E'] = df['SIGNAL_X_KIJ_TEN'][df.index[-1]]
-	nodes['F'] = df['SIGNAL_X_CHI_SSB'][df.index[-1]]
-
-	sum_nodes_long = 0
-	sum_nodes_shrt = 0
-
-	for node in nodes:
-		if (nodes[node] == 1):
-			sum_nodes_long = sum_nodes_long + 1
-		if (nodes[node] == -1):
-			sum_nodes_shrt = sum_nodes_shrt + 1
-
-	# We don't want to keep inside cloud signals
-	if (df['SIGNAL_PRC_CLD'][df.index[-1]] != 0):
-		# We want to remove contradictory signals
-		if (sum_nodes_long >= 1) and (sum_nodes_shrt == 0):
-			# We don't want to receive cloud signal if not confirmed by Chikou
-			if (sum_nodes_long == 1) and (nodes['A'] == 1) and (df['SIGNAL_CHI_SSB'][df.index[-1]] != 1):
-				myprint("Cloud signal received but not confirmed by Chikou !")
-				return 0
-
-			# We don't want to get false signals from Chikou (bounces, etc.)
-			if ((sum_nodes_long == 1) and ((nodes['C'] == 1) or (nodes['D'] == 1) or (nodes['F'] == 1))):
-				if (df['SIGNAL_X_CHI_PRC'][df.index[-1] - 1] == -1) or (df['SIGNAL_X_CHI_PRC'][df.index[-1] - 2] == -1):
-					return 0
-				if (df['SIGNAL_X_CHI_KIJ'][df.index[-1] - 1] == -1) or (df['SIGNAL_X_CHI_KIJ'][df.index[-1] - 2] == -1):
-					return 0
-				if (df['SIGNAL_X_CHI_SSB'][df.index[-1] - 1] == -1) or (df['SIGNAL_X_CHI_SSB'][df.index[-1] - 2] == -1):
-					return 0
-
-			# We don't want to buy if prices are under Kijun
-			if (df['SIGNAL_KIJ_PRC'][df.index[-1]] != 1):
-				myprint("Long signal received but not confirmed by Kijun !")
-				return 0
-
-			return df['SIGNAL_RATIO_LONG'][df.index[-1]]
-
-		if (sum_nodes_shrt >= 1) and (sum_nodes_long == 0):
-			# We don't want to receive cloud signal if not confirmed by Chikou
-			if (sum_nodes_shrt == 1) and (nodes['A'] == -1) and (df['SIGNAL_CHI_SSB'][df.index[-1]] != -1):
-				myprint("Cloud signal received but not confirmed by Chikou !")
-				return 0
-
-			# We don't want to get false signals from Chikou (bounces, etc.)
-			if ((sum_nodes_shrt == 1) and ((nodes['C'] == -1) or (nodes['D'] == -1) or (nodes['F'] == -1))):
-				if (df['SIGNAL_X_CHI_PRC'][df.index[-1] - 1] == 1) or (df['SIGNAL_X_CHI_PRC'][df.index[-1] - 2] == 1):
-					return 0
-				if (df['SIGNAL_X_CHI_KIJ'][df.index[-1] - 1] == 1) or (df['SIGNAL_X_CHI_KIJ'][df.index[-1] - 2] == 1):
-					return 0
-				if (df['SIGNAL_X_CHI_SSB'][df.index[-1] - 1] == 1) or (df['SIGNAL_X_CHI_SSB'][df.index[-1] - 2] == 1):
-					return 0
-
-			# We don't want to buy if prices are under Kijun
-			if (df['SIGNAL_KIJ_PRC'][df.index[-1]] != -1):
-				myprint("Long signal received but not confirmed by Kijun !")
-				return 0
-
-			return df['SIGNAL_RATIO_SHORT'][df.index[-1]]
-	else:
-		myprint("Signal Received but prices in cloud !")
+def trim_bars(bars, rng):
+	if (len(bars) == 0):
+		return bars
 
-	return 0
+	return bars[bars['timestamp'] >= bars['timestamp'][-1] - RANGE_SECONDS[rng] - CACHE_MARGIN]
 
 
 #
-# Write Email with correct values taken from DataFrame
+# Retrieve chart from cache, requesting only the bars after the last cached one
 #
-def write_email(scores, closes):
-	myprint("BUILDING MESSAGE...")
+def fetch_cached_chart(symbol, ntvl, rng):
+	bars, meta = load_bars(symbol, ntvl)
 
-	if (OUTPUT == "TXT"):
-		MSG		= "SIGNALS " + INTERVAL + "\n\n"
-		BUY_MSG		= "LONG :\n"
-		SELL_MSG 	= "SHORT :\n"
-		CLSEB_MSG 	= "CLOSE LONG :\n"
-		CLSES_MSG 	= "CLOSE SHORT :\n"
-	else :
-		MSG		= "<html><body>SIGNALS " + INTERVAL + "<br/><br/>"
-		BUY_MSG		= "<span style='color:green'><b>LONG :</b></span><br/><ul>"
-		SELL_MSG 	= "<span style='color:red'><b>SHORT :</b></span><br/><ul>"
-		CLSEB_MSG 	= "<span style='color:orange'><b>CLOSE LONG :</b></span><br/><ul>"
-		CLSES_MSG 	= "<span style='color:orange'><b>CLOSE SHORT :</b></span><br/><ul>"
-
-	buy	= False
-	sell	= False
-	close_b	= False
-	close_s	= False
-
-	table = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-	for score in table:
-		if (score[1] > 66):
-			buy = True
-			if (OUTPUT == "TXT"):
-				BUY_MSG = BUY_MSG + "\t- " + score[0] + " : " + str(int(score[1])) + "%\n"
-			else:
-				BUY_MSG = BUY_MSG + "<li><span style='color:green'><b>" + score[0] + " : " + str(int(score[1])) + "%</b></span></li>"
+	if (bars is not None) and (len(bars) > 0):
+		# Past analysis is replayed from cache only
+		if (RM_VALUES > 0):
+			myprint("GET QUOTE DATA : " + symbol + " from cache")
+			return bars_to_chart(np.array(bars), meta)
 
+		bars, meta = request_tail(symbol, ntvl, bars, meta)
 
-	table = sorted(scores.items(), key=lambda x: x[1])
-	for score in table:
-		if (score[1] < -66):
-			sell = True
-			if (OUTPUT == "TXT"):
-				SELL_MSG = SELL_MSG + "\t- " + score[0] + " : " + str(int(score[1])) + "%\n"
-			else:
-				SELL_MSG = SELL_MSG + "<li><span style='color:red'><b>" + score[0] + " : " + str(int(score[1])) + "%</b></span></li>"
+		if (bars is not None):
+			bars = trim_bars(bars, rng)
+			save_bars(symbol, ntvl, bars, meta)
+			return bars_to_chart(bars, meta)
 
-	closes = sorted(closes.items(), key=lambda x: x[0])
-	for cls in closes:
-		if (OUTPUT == "TXT"):
-			tmpmess = "\t- " + cls[0] + " : " + str(int(cls[1])) + "%\n"
-		else:
-			tmpmess ="<li><span style='color:orange'><b>" + cls[0] + " : " + str(int(cls[1])) + "%</b></span></li>"
+		myprint("WARNING: Incremental request failed for " + symbol + ". Requesting whole range...")
 
-		if (cls[1] == 1):
-			if os.path.isfile("./MYTRADES/" + cls[0] + "_" + INTERVAL + "_long"):
-				close_b = True
-				CLSEB_MSG = CLSEB_MSG + tmpmess
-		else:
-			if os.path.isfile("./MYTRADES/" + cls[0] + "_" + INTERVAL + "_short"):
-				close_s = True
-				CLSES_MSG = CLSES_MSG + tmpmess
-
-	if (OUTPUT != "TXT"):
-		if (buy):
-			MSG = MSG + BUY_MSG + "</ul><br/>"
-		if (sell):
-			MSG = MSG + SELL_MSG + "</ul><br/>"
-		if (close_b):
-			MSG = MSG + CLSEB_MSG + "</ul><br/>"
-		if (close_s):
-			MSG = MSG + CLSES_MSG + "</ul><br/>"
-	else:
-		if (buy):
-			MSG = MSG + BUY_MSG + "\n"
-		if (sell):
-			MSG = MSG + SELL_MSG + "\n"
-		if (close_b):
-			MSG = MSG + CLSEB_MSG + "\n"
-		if (close_s):
-			MSG = MSG + CLSES_MSG + "\n"
-
-	if (buy or sell or close_b or close_s):
-		return MSG
-	else:
-		return None
+	data = request_chart(symbol, '?range=' + rng + '&interval=' + ntvl)
 
+	if (data != None) and (data['chart']['result'] != None):
+		body = data['chart']['result'][0]
+		save_bars(symbol, ntvl, body_to_bars(body), body['meta'])
 
-def process_symbol(symbol):
-	global scores
-	global closes
+	return data
 
-	myprint("SYMBOL: " + symbol)
 
-	df 	= get_quote_data(symbol, INTERVAL, 1)
+#
+# Null values (excluding weekends) of chart bars, in exchange local time
+#
+def null_values(timestamps, opn, gmtoffset):
+	weekday = ((timestamps + gmtoffset) // 86400 + 3) % 7
 
-	symbol = symbol.rstrip().replace(".","_").replace("-","_").replace("/","_")
+	return np.isnan(opn) & (weekday < 6)
+
+
+#
+# Timestamps of null values in chart JSON (empty if none)
+#
+def chart_nulls(data):
+	if (data == None) or (data['chart']['result'] == None):
+		return np.array([], dtype=np.int64)
+
+	body		= data['chart']['result'][0]
+	timestamps	= np.array(body.get('timestamp', []), dtype=np.int64)
+	opn		= np.array(body['indicators']['quote'][0]['open'], dtype=float)
+
+	return timestamps[null_values(timestamps, opn, body['meta'].get('gmtoffset', 0))]
+
+
+#
+# Request again bars of the time range containing null values & merge them in chart JSON
+#
+def recheck_chart(symbol, ntvl, data, nulls):
+	ntvl, rng = chart_params(ntvl)
+
+	period1 = int(nulls[0])
+	period2 = int(nulls[-1]) + INTERVAL_SECONDS.get(ntvl, 86400)
+
+	metrics.count("retries")
+	new = request_chart(symbol, '?period1=' + str(period1) + '&period2=' + str(period2) + '&interval=' + ntvl)
+
+	if (new == None) or (new['chart']['result'] == None):
+		return data
+
+	body = data['chart']['result'][0]
+	bars = body_to_bars(body)
+	new  = body_to_bars(new['chart']['result'][0])
+	new  = new[(new['timestamp'] >= period1) & (new['timestamp'] < period2)]
+
+	bars = np.concatenate([bars[bars['timestamp'] < period1], new, bars[bars['timestamp'] >= period2]])
+
+	if (CACHE_DIR != None):
+		save_bars(symbol, ntvl, bars, body['meta'])
+
+	return bars_to_chart(bars, body['meta'])
+
+
+#
+# Bars archive : bars of all markets for one interval in a single file (BAR_DTYPE records, markets one after
+# another) & index of symbol -> [offset, count, meta]. Bars are read as views of the memory-mapped file.
+#
+ARCHIVE_RANGES	= {'30m': '60d', '1h': '730d', '1d': 'max'}
+RANGE_SECONDS	= {'10d': 10 * 86400, '4mo': 122 * 86400, '2y': 730 * 86400}
+
+class BarArchive:
+	def __init__(self, path, ntvl):
+		self.path = os.path.join(path, "bars_" + ntvl)
+
+		with open(self.path + ".json") as f:
+			self.index = json.load(f)
+
+		self.bars = np.zeros(0, dtype=BAR_DTYPE)
+		if (os.path.getsize(self.path + ".bin") > 0):
+			self.bars = np.memmap(self.path + ".bin", dtype=BAR_DTYPE, mode='r')
+
+	def __contains__(self, symbol):
+		return symbol in self.index
+
+	# Bars of symbol (from start timestamp if given) & metadata, without copy
+	def get(self, symbol, start=None):
+		offset, count, meta = self.index[symbol]
+		bars = self.bars[offset:offset + count]
+
+		if (start != None):
+			bars = bars[np.searchsorted(bars['timestamp'], start):]
+
+		return bars, meta
+
+	# Write archive from (symbol, bars, meta) items, one market at a time (written to temporary files first, then renamed)
+	@staticmethod
+	def build(path, ntvl, items):
+		path	= os.path.join(path, "bars_" + ntvl)
+		tmp	= path + "." + str(os.getpid()) + ".tmp"
+		index	= {}
+		offset	= 0
+
+		with open(tmp + ".bin", 'wb') as f:
+			for symbol, bars, meta in items:
+				f.write(np.ascontiguousarray(bars, dtype=BAR_DTYPE).tobytes())
+				index[symbol] = [offset, len(bars), meta]
+				offset += len(bars)
+		with open(tmp + ".json", 'w') as f:
+			json.dump(index, f)
+
+		os.replace(tmp + ".bin", path + ".bin")
+		os.replace(tmp + ".json", path + ".json")
+
+
+#
+# Retrieve whole available history of a market for archive (merged with cached bars)
+#
+def fetch_history(symbol, ntvl):
+	data = request_chart(symbol, '?range=' + ARCHIVE_RANGES[ntvl] + '&interval=' + ntvl)
+
+	if (data == None) or (data['chart']['result'] == None):
+		return data
+
+	body = data['chart']['result'][0]
+	bars = body_to_bars(body)
+
+	if (CACHE_DIR != None):
+		cached, meta = load_bars(symbol, ntvl)
+		if (cached is not None):
+			bars = merge_bars(cached, bars)
+
+	return bars_to_chart(bars, body['meta'])
 
-	if (INTERVAL == "4h"):
-		df = transform_four_hours(df)
 
-	if (df is None) :
+#
+# Build bars archive of all markets for each Yahoo interval to request
+#
+def build_archive():
+	os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+	for ntvl in interval_groups(INTERVALS):
+		def items():
+			for symbol, data in fetch_all(MARKETS, ntvl, fetch_history):
+				if (data == None) or (data['chart']['result'] == None):
+					myprint("ERROR: Market " + symbol + " unknown! Passing...")
+					continue
+
+				body = data['chart']['result'][0]
+				yield symbol, body_to_bars(body), body['meta']
+
+		BarArchive.build(ARCHIVE_DIR, ntvl, items())
+		myprint("ARCHIVE: " + os.path.join(ARCHIVE_DIR, "bars_" + ntvl) + " written.")
+
+
+#
+# Read raw charts of markets from archive (only the range requested for interval, whole history for backtest).
+# Markets missing from archive have no chart (None), they are never requested.
+#
+def archive_charts(symbols, ntvl):
+	try:
+		archive = BarArchive(ARCHIVE_DIR, ntvl)
+	except (OSError, ValueError) as e:
+		print("ERROR: Archive unreadable for " + ntvl + " interval (" + str(e) + ").")
 		return
 
-	df 	= processIchimoku(df)
-	score   = process_score(df)
+	rng = chart_params(ntvl)[1]
+
+	for symbol in symbols:
+		if (symbol not in archive):
+			myprint("ERROR: Market " + symbol + " not in " + ntvl + " archive!")
+			metrics.count("archive_misses")
+			yield symbol, None
+			continue
+
+		bars, meta = archive.get(symbol)
+		if not full_history() and (len(bars) > 0):
+			bars, meta = archive.get(symbol, bars['timestamp'][-1] - RANGE_SECONDS[rng])
+
+		yield symbol, bars_to_chart(bars, meta)
+
+
+#
+# Raw charts of markets, read from archive if enabled or requested concurrently
+#
+def market_charts(symbols, ntvl):
+	if (ARCHIVE_DIR != None):
+		return archive_charts(symbols, ntvl)
+
+	return fetch_all(symbols, ntvl)
+
+
+#
+# Retrieve raw chart JSON for all symbols concurrently, yielded as soon as available.
+# Charts with null values are requested again (null values range only, if RECHECK) with
+# exponential backoff, without blocking other symbols.
+#
+def fetch_all(symbols, ntvl, fetch=fetch_chart):
+	get_session()
+
+	with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+		pending	= {executor.submit(fetch, symbol, ntvl): (symbol, 0) for symbol in symbols}
+		retries	= []
+
+		# Requests not started yet are cancelled if charts are not all consumed
+		try:
+			while (len(pending) > 0) or (len(retries) > 0):
+				# Submitting rechecks which are due
+				now = time.monotonic()
+				while (len(retries) > 0) and (retries[0][0] <= now):
+					due, n, symbol, attempt, data, nulls = heapq.heappop(retries)
+					pending[executor.submit(recheck_chart, symbol, ntvl, data, nulls)] = (symbol, attempt)
+
+				timeout = (retries[0][0] - now) if (len(retries) > 0) else None
+
+				if (len(pending) == 0):
+					time.sleep(timeout)
+					continue
+
+				done, not_done = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+				for future in done:
+					symbol, attempt = pending.pop(future)
+					data  = future.result()
+					nulls = chart_nulls(data) if RECHECK else []
+
+					if (len(nulls) > 0) and (attempt < RECHECK_ATTEMPTS):
+						myprint("WARNING: " + symbol + " has Null values. Trying again...")
+						heapq.heappush(retries, (time.monotonic() + RECHECK_DELAY * 2 ** attempt, len(retries) + len(pending), symbol, attempt + 1, data, nulls))
+					else:
+						yield symbol, data
+		finally:
+			executor.shutdown(cancel_futures=True)
+
+
+#
+# Retrieve data from Yahoo Finance & return DataFrame
+# (Ichimoku lines & SIGNAL_* columns are only added by processIchimoku).
+# Chart is requested only if no data is given : None data is a failed or missing chart, not requested again.
+#
+PRICE_COLUMNS	= ['open', 'high', 'low', 'close', 'volume']
+FETCH		= object()
+QUOTE_BARS	= 500
+
+def get_quote_data(symbol, ntvl, data=FETCH):
+	if (data is FETCH):
+		data = fetch_chart(symbol, ntvl)
+
+	if (data == None) or (data['chart']['result'] == None):
+		myprint("ERROR: Market unknown! Passing...")
+		return None
+
+	start	= time.perf_counter()
+	body	= data['chart']['result'][0]
+	quote	= body['indicators']['quote'][0]
+
+	# Prices as float32 columns, volume as float64 (float32 is not exact above 2^24), market metadata stored once in DataFrame attributes
+	df = pd.DataFrame({name: np.array(quote[name], dtype=(np.float64 if (name == 'volume') else np.float32)) for name in PRICE_COLUMNS})
+	df['timestamp']		= np.array(body['timestamp'], dtype=np.int64)
+
+	df.attrs['timezone']	= body['meta']['exchangeTimezoneName']
+	df.attrs['exchange']	= body['meta']['exchangeName']
 
-	pd.set_option('display.max_rows', 25)
-	myprint(df[['timestamp', 'open', 'close', 'SIGNAL_KIJ_PRC', 'SIGNAL_X_PRC_CLD', 'SIGNAL_X_CHI_KIJ', 'SIGNAL_X_KIJ_TEN', 'SIGNAL_X_KIJ_PRC', 'SIGNAL_X_CHI_PRC', 'SIGNAL_CHI_SSB', 'SIGNAL_RATIO_LONG', 'SIGNAL_RATIO_SHORT']])
 	pd.set_option('display.max_rows', None)
 
-	f = open('test.csv', 'a')
-	if (score > 66):
-		f.write("LONG,"  + str(df['timestamp'][len(df)-1]) + "," + str(symbol) + "," + str(int(score)) + ',' + str(df['close'][len(df)-1]) + "\n")
-	if (score < -66):
-		f.write("SHORT,"  + str(df['timestamp'][len(df)-1]) + "," + str(symbol) + "," + str(int(score)) + ',' + str(df['close'][len(df)-1]) + "\n")
+	metrics.observe("frame", time.perf_counter() - start, symbol)
+
+	# Checking for Null / Error values, excluding weekends
+	if np.any(null_values(df['timestamp'].to_numpy(), df['open'].to_numpy(), body['meta'].get('gmtoffset', 0))):
+		myprint("WARNING: Market has too many Null values for processing. Maybe errors...")
+		metrics.count("null_rejections")
+
+	if (df['volume'][df.index[-1]] == 0):
+		df = df[:-1]
+
+	df = df[:len(df) - RM_VALUES]
+
+	# 1h bars kept must be enough for H4 candles (up to 4 bars each, last one may be incomplete)
+	if not full_history():
+		size = QUOTE_BARS
+		if (ntvl == "1h") and ("4h" in INTERVALS):
+			size = max(size, 4 * (H4_BARS + 2))
+		df = df[-size:]
+	df.dropna(inplace=True)
+	df.reset_index(drop=True, inplace=True)
+
+	if (len(df) <= int(max(config[2] for config in CONFIGS) * 1.5)):
+		myprint("ERROR: Market has too few history for Ichimoku! Passing...")
+		return None
+
+	return df
 
-	f.close()
-	scores[symbol]  = score
 
 
 #
-# Main function
+# Sessions sequences for H4 candle transformation, from end of session backwards (depends on markets).
+# Markets without sequence (crypto, metals, ...) are grouped in 4h blocks of exchange local time.
 #
-def main():
-	global scores
-	global closes
+H4_SEQUENCES = {
+	'Europe':	[4,4,1],
+	'America':	[3,4],
+}
 
-	# For each market, retrieve, process and write in email
-	for symbol in MARKETS:
-		process_symbol(symbol)
+def h4_sequence(tz, exchange):
+	region = tz.split('/')[0]
 
-	# Write & send message
-	MSG = write_email(scores, closes)
-	if (MSG != None):
-		if (OUTPUT == "EMAIL"):
-			send_email(MSG + "</body></html>")
-		else:
-			print(MSG)
+	if (region == "America") and (exchange == "CMX"):
+		return None
+
+	return H4_SEQUENCES.get(region)
+
+
+#
+# Transform a 1h dataframe into a 4h (Yahoo does not provide 4h's one)
+#
+H4_BARS = 130
+
+def transform_four_hours(df):
+	myprint("ENTERING H4 PROCESSING...")
+
+	tz	 = df.attrs['timezone']
+	exchange = df.attrs['exchange']
+	sequence = h4_sequence(tz, exchange)
+
+	# Exchange local date & hour of each candle
+	local	= pd.to_datetime(df['timestamp'], unit='s', utc=True).dt.tz_convert(tz).dt.tz_localize(None)
+	day	= local.to_numpy().astype('datetime64[D]').astype(np.int64)
+	hour	= local.dt.hour.to_numpy()
+
+	# Group labels : H4 candle index within the session day
+	if (sequence != None):
+		sizes	= np.array(sequence[::-1] + [1])
+		bounds	= np.cumsum(sequence[::-1])
+		pos	= df.groupby(day).cumcount().to_numpy()
+		chunk	= np.searchsorted(bounds, pos, side='right')
+	else:
+		chunk	= hour // 4
+
+	labels	= day * 8 + chunk
+	starts	= np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+	ends	= np.r_[starts[1:], len(df)] - 1
+
+	# Last H4 candle is removed while not complete
+	if (sequence != None):
+		complete = (ends[-1] - starts[-1] + 1) >= sizes[chunk[-1]]
+	else:
+		complete = (hour[-1] % 4) == 3
+
+	if not complete:
+		starts	= starts[:-1]
+		ends	= ends[:-1]
+
+	# Insure we have sufficient values to trasnform H1 data to H4 data (80 rows min for ichimoku)
+	if (len(starts) <= H4_BARS):
+		myprint("ERROR: Market has too few history for H4 ichimoku! Passing...")
+		return None
+
+	if not full_history():
+		starts	= starts[-H4_BARS:]
+		ends	= ends[-H4_BARS:]
+	stops	= np.r_[starts[1:], ends[-1] + 1]
+
+	df4 = pd.DataFrame({
+		'open':		df['open'].to_numpy()[starts],
+		'high':		np.maximum.reduceat(df['high'].to_numpy()[starts[0]:stops[-1]], starts - starts[0]),
+		'low':		np.minimum.reduceat(df['low'].to_numpy()[starts[0]:stops[-1]], starts - starts[0]),
+		'close':	df['close'].to_numpy()[ends],
+		'volume':	np.add.reduceat(df['volume'].to_numpy()[starts[0]:stops[-1]], starts - starts[0]),
+		'timestamp':	df['timestamp'].to_numpy()[starts],
+	})
+
+	df4.attrs['timezone']	= tz
+	df4.attrs['exchange']	= exchange
+
+	df4 = df4[:len(df4) - RM_VALUES]
+
+	return df4
+
+#
+# Email notifier : messages are queued & sent by a background thread on one reusable SMTP connection
+# (connection is checked before use & opened again if needed, failed deliveries are retried with backoff)
+#
+class Notifier:
+	def __init__(self, server, port, auth, plain=False):
+		self.server	= server
+		self.port	= port
+		self.auth	= auth
+		self.plain	= plain
+		self.smtp	= None
+		self.queue	= queue.Queue()
+		self.thread	= threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def connect(self):
+		if (self.smtp != None):
+			try:
+				if (self.smtp.noop()[0] == 250):
+					return self.smtp
+			except (smtplib.SMTPException, OSError):
+				pass
+			self.close()
+
+		smtp = smtplib.SMTP(self.server, self.port, timeout=30)
+		smtp.ehlo()
+		# STARTTLS is mandatory (fails if not supported by server) unless plain text is explicitly requested
+		if not self.plain:
+			smtp.starttls()
+			smtp.ehlo()
+		if (self.auth != None):
+			smtp.login(self.auth[0], self.auth[1])
+
+		self.smtp = smtp
+		return smtp
+
+	def close(self):
+		if (self.smtp != None):
+			try:
+				self.smtp.quit()
+			except (smtplib.SMTPException, OSError):
+				pass
+			self.smtp = None
+
+	# Returns future of delivery (True once sent, False if all attempts failed)
+	def send(self, sender, recipients, message):
+		delivery = Future()
+		self.queue.put((sender, recipients, message, delivery))
+		return delivery
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if (item == None):
+				self.close()
+				return
+
+			# Delivery always gets a result (even on unexpected error), so that nobody waits for it forever
+			sender, recipients, message, delivery = item
+			sent = False
+			try:
+				for attempt in range(0, NOTIFY_ATTEMPTS):
+					try:
+						with metrics.timer("email"):
+							self.connect().sendmail(sender, recipients, message.as_string())
+						metrics.count("emails")
+						sent = True
+						break
+					except (smtplib.SMTPException, OSError) as e:
+						self.close()
+						if (attempt + 1 < NOTIFY_ATTEMPTS):
+							myprint("WARNING: Email to " + ", ".join(recipients) + " not sent (" + str(e) + "). Trying again...")
+							time.sleep(NOTIFY_DELAY * 2 ** attempt)
+						else:
+							print("ERROR: Email to " + ", ".join(recipients) + " not sent (" + str(e) + ").")
+							metrics.count("emails_failed")
+			except Exception as e:
+				print("ERROR: Email to " + ", ".join(recipients) + " not sent (" + repr(e) + ").")
+				metrics.count("emails_failed")
+				self.smtp = None
+			finally:
+				delivery.set_result(sent)
+
+	# Waits for queued emails to be sent, then closes connection
+	def quit(self):
+		self.queue.put(None)
+		self.thread.join()
+
+
+#
+# Return email notifier (started on first email)
+#
+def get_notifier():
+	global notifier
+
+	if (notifier == None):
+		notifier = Notifier(SMTP_SERVER, SMTP_PORT, SMTP_AUTH, SMTP_PLAIN)
+
+	return notifier
+
+
+#
+# Send queued emails & close SMTP connection
+#
+def close_notifier():
+	global notifier
+
+	if (notifier != None):
+		notifier.quit()
+		notifier = None
+
+
+#
+# Sends Email to recipients (queued, delivered in background), returns future of delivery
+#
+def send_email(msg, recipients, title=""):
+	myprint("SENDING EMAIL...")
+
+	sender = "Trading Server"
+
+	from email.mime.text import MIMEText
+	from email.mime.multipart import MIMEMultipart
+
+	message = MIMEMultipart("alternative")
+	message["Subject"] = "Trading Opportunities " + title + "(" +  datetime.now().strftime('%d/%m %H:%M')  + ") !"
+	message["From"] = "Trading Server"
+	message["To"] = ", ".join(recipients)
+
+	message.attach(MIMEText(msg,"html"))
+
+	return get_notifier().send(sender, recipients, message)
+
+
+#
+# Alerts (symbol, interval, config) of signals in scores
+#
+def alert_keys(scores):
+	return [(symbol, key[0], "-".join(map(str, key[1]))) for key in scores for symbol, score in scores[key].items() if (abs(score) > 66)]
+
+
+#
+# Messages to send : (recipients, title, message, alerts) for all recipients at once, each recipient or each market with signals
+#
+def digests(scores, closes):
+	recipients = [recipient.strip() for recipient in RECIPIENTS.split(",") if (recipient.strip() != "")]
+
+	if (DIGEST == "MARKET"):
+		symbols = set()
+		for key in scores:
+			symbols.update(symbol for symbol, score in scores[key].items() if (abs(score) > 66))
+		for key in closes:
+			symbols.update(closes[key])
+
+		messages = []
+		for symbol in sorted(symbols):
+			market	= {key: {s: v for s, v in scores[key].items() if (s == symbol)} for key in scores}
+			MSG	= write_email(market, {key: {s: v for s, v in closes[key].items() if (s == symbol)} for key in closes})
+			if (MSG != None):
+				messages.append((recipients, symbol + " ", MSG, alert_keys(market)))
+
+		return messages
+
+	MSG = write_email(scores, closes)
+	if (MSG == None):
+		return []
+
+	if (DIGEST == "RECIPIENT"):
+		return [([recipient], "", MSG, alert_keys(scores)) for recipient in recipients]
+
+	return [(recipients, "", MSG, alert_keys(scores))]
+
+
+#
+# Shift array values n bars forward along the time (last) axis, padding with fill
+#
+def lag(values, n, fill=np.nan):
+	out = np.full(values.shape, fill, dtype=np.result_type(values, np.asarray(fill)))
+	if (n < values.shape[-1]):
+		out[..., n:] = values[..., :values.shape[-1] - n]
+	return out
+
+
+#
+# Rolling (highest high + lowest low) / 2 over n bars, NaN until the window is full
+#
+def rolling_midpoint(high, low, n):
+	mid = np.full(high.shape, np.nan)
+	if (high.shape[-1] >= n):
+		highest	= np.lib.stride_tricks.sliding_window_view(high, n, axis=-1).max(axis=-1)
+		lowest	= np.lib.stride_tricks.sliding_window_view(low, n, axis=-1).min(axis=-1)
+		mid[..., n-1:] = (highest + lowest) / 2
+	return mid
+
+
+#
+# Range max / min index (sparse table) : highest high & lowest low of any window in O(1) once built in O(n log n).
+# Level k holds max / min of blocks of 2^k bars, a window is covered by two overlapping blocks.
+#
+class RangeIndex:
+	def __init__(self, high, low):
+		self.highs	= [np.asarray(high, dtype=float)]
+		self.lows	= [np.asarray(low, dtype=float)]
+		self.mids	= {}
+
+		span = 1
+		while (2 * span <= len(self.highs[0])):
+			self.highs.append(np.maximum(self.highs[-1][:-span], self.highs[-1][span:]))
+			self.lows.append(np.minimum(self.lows[-1][:-span], self.lows[-1][span:]))
+			span *= 2
+
+	# Rolling (highest high + lowest low) / 2 over n bars, NaN until the window is full (as rolling_midpoint)
+	def midpoint(self, n):
+		if (n not in self.mids):
+			size	= len(self.highs[0])
+			mid	= np.full(size, np.nan)
+
+			if (n <= size):
+				k	= n.bit_length() - 1
+				span	= 1 << k
+				highest	= np.maximum(self.highs[k][:size - n + 1], self.highs[k][n - span:size - span + 1])
+				lowest	= np.minimum(self.lows[k][:size - n + 1], self.lows[k][n - span:size - span + 1])
+				mid[n-1:] = (highest + lowest) / 2
+
+			self.mids[n] = mid
+
+		return self.mids[n]
+
+
+#
+# Compute Ichimoku lines for the whole history (SSA / SSB are displaced by Kijun period).
+# Midpoints can be taken from a RangeIndex (midpoint function of period).
+#
+def ichimoku_lines(high, low, config, midpoint=None):
+	if (midpoint == None):
+		midpoint = lambda n: rolling_midpoint(high, low, n)
+
+	lines = {}
+	lines['KIJUNSEN']	= midpoint(config[1])
+	lines['TENKANSEN']	= midpoint(config[0])
+	lines['SSA']		= lag((lines['KIJUNSEN'] + lines['TENKANSEN']) / 2, config[1])
+	lines['SSB']		= lag(midpoint(config[2]), config[1])
+	return lines
+
+
+#
+# Compute SIGNAL_* values for the whole history from prices & Ichimoku lines
+#
+def ichimoku_signals(opn, close, lines, config):
+	kij	= lines['KIJUNSEN']
+	ten	= lines['TENKANSEN']
+	ssa	= lines['SSA']
+	ssb	= lines['SSB']
+	k	= config[1]
+
+	close_1		= lag(close, 1)
+	close_k		= lag(close, k)
+	close_k1	= lag(close, k+1)
+	kij_1		= lag(kij, 1)
+	kij_k		= lag(kij, k)
+	kij_k1		= lag(kij, k+1)
+	ten_1		= lag(ten, 1)
+	ssb_k		= lag(ssb, k)
+	ssb_k1		= lag(ssb, k+1)
+
+	def signal(up, down):
+		return np.where(down, -1, np.where(up, 1, 0))
+
+	sig = {}
+
+	# Are we in a bullish (BUY) or bearish (SELL) trend ?
+	sig['SIGNAL_PRC_CLD']	= signal((close > ssa) & (close > ssb) & ((opn > ssa) | (opn > ssb)),
+					 (close < ssa) & (close < ssb) & ((opn < ssa) | (opn < ssb)))
+
+	# Do we have a cloud buying / selling signal (price going above / under cloud) ?
+	prc_cld_1 = lag(sig['SIGNAL_PRC_CLD'], 1, 0)
+	sig['SIGNAL_X_PRC_CLD']	= signal((sig['SIGNAL_PRC_CLD'] == 1) & (prc_cld_1 != 1), (sig['SIGNAL_PRC_CLD'] == -1) & (prc_cld_1 != -1))
+
+	# Is Chikou crossing Kijun ?
+	sig['SIGNAL_X_CHI_KIJ']	= signal((close_1 <= kij_k1) & (close >= kij_k), (close_1 >= kij_k1) & (close <= kij_k))
+
+	# Is Kijun crossing Tenkan ?
+	sig['SIGNAL_X_KIJ_TEN']	= signal((kij_1 >= ten_1) & (kij < ten), (kij_1 <= ten_1) & (kij > ten))
+
+	# Is Kijun crossing Price ?
+	sig['SIGNAL_X_KIJ_PRC']	= signal((kij_1 >= close_1) & (kij <= close), (kij_1 <= close_1) & (kij >= close))
+
+	# Is Chikou crossing SSB ?
+	sig['SIGNAL_X_CHI_SSB']	= signal((ssb_k1 >= close_1) & (ssb_k < close), (ssb_k1 <= close_1) & (ssb_k > close))
+
+	# Is Chikou crossing Price ?
+	sig['SIGNAL_X_CHI_PRC']	= signal((close_k1 >= close_1) & (close_k < close), (close_k1 <= close_1) & (close_k > close))
+
+	# Is Price under of above Kijun ?
+	sig['SIGNAL_KIJ_PRC']	= signal(kij < close, kij > close)
+
+	# Is Chikou under or above Price ?
+	sig['SIGNAL_CHI_PRC']	= signal(close > close_k, close < close_k)
+
+	# Is Chikou under or above Kijun ?
+	sig['SIGNAL_CHI_KIJ']	= signal(close > kij_k, close < kij_k)
+
+	# Is Kijun under or above Tenkan ?
+	sig['SIGNAL_KIJ_TEN']	= signal(kij < ten, kij > ten)
+
+	# Is Chikou under or above SSB ?
+	sig['SIGNAL_CHI_SSB']	= signal(close > ssb_k, close < ssb_k)
+
+	# Processing percent of SHORT and LONG signals
+	nodes = np.stack([sig['SIGNAL_PRC_CLD'], sig['SIGNAL_KIJ_PRC'], sig['SIGNAL_CHI_PRC'], sig['SIGNAL_CHI_KIJ'], sig['SIGNAL_KIJ_TEN'], sig['SIGNAL_CHI_SSB']])
+	sig['SIGNAL_RATIO_LONG']	= np.sum(nodes == 1, axis=0) * 100 / 6
+	sig['SIGNAL_RATIO_SHORT']	= - np.sum(nodes == -1, axis=0) * 100 / 6
+
+	return sig
+
+
+#
+# Rolling (highest high + lowest low) / 2 over n bars, updated bar by bar with monotonic deques
+#
+class RollingMidpoint:
+	def __init__(self, n):
+		self.n		= n
+		self.count	= 0
+		self.highs	= deque()
+		self.lows	= deque()
+
+	def update(self, high, low):
+		i = self.count
+		self.count += 1
+
+		# Deques keep (index, value) of candidates only : decreasing highs & increasing lows
+		while (len(self.highs) > 0) and (self.highs[-1][1] <= high):
+			self.highs.pop()
+		while (len(self.lows) > 0) and (self.lows[-1][1] >= low):
+			self.lows.pop()
+
+		self.highs.append((i, high))
+		self.lows.append((i, low))
+
+		if (self.highs[0][0] <= i - self.n):
+			self.highs.popleft()
+		if (self.lows[0][0] <= i - self.n):
+			self.lows.popleft()
+
+		if (self.count < self.n):
+			return np.nan
+
+		return (self.highs[0][1] + self.lows[0][1]) / 2
+
+
+#
+# Ichimoku lines & SIGNAL_* values updated bar by bar, same values as processIchimoku on the last bar
+#
+class IchimokuState:
+	def __init__(self, config):
+		self.config	= config
+		k		= config[1]
+
+		self.kijun	= RollingMidpoint(config[1])
+		self.tenkan	= RollingMidpoint(config[0])
+		self.senkou	= RollingMidpoint(config[2])
+
+		# Histories needed for displaced values (most recent last)
+		self.kij	= deque([np.nan] * (k + 2), maxlen=k + 2)
+		self.ten	= deque([np.nan] * (k + 2), maxlen=k + 2)
+		self.close	= deque([np.nan] * (k + 2), maxlen=k + 2)
+		self.ssb	= deque([np.nan] * (2 * k + 2), maxlen=2 * k + 2)
+		self.prc_cld	= 0
+
+	def update(self, opn, high, low, close):
+		k = self.config[1]
+
+		self.kij.append(self.kijun.update(high, low))
+		self.ten.append(self.tenkan.update(high, low))
+		self.ssb.append(self.senkou.update(high, low))
+		self.close.append(close)
+
+		kij, kij_1, kij_k, kij_k1	= self.kij[-1], self.kij[-2], self.kij[-1-k], self.kij[-2-k]
+		ten, ten_1			= self.ten[-1], self.ten[-2]
+		close_1, close_k, close_k1	= self.close[-2], self.close[-1-k], self.close[-2-k]
+		ssa				= (kij_k + self.ten[-1-k]) / 2
+		ssb, ssb_k, ssb_k1		= self.ssb[-1-k], self.ssb[-1-2*k], self.ssb[-2-2*k]
+
+		def signal(up, down):
+			return -1 if down else (1 if up else 0)
+
+		row = {'KIJUNSEN': kij, 'TENKANSEN': ten, 'SSA': ssa, 'SSB': ssb}
+
+		row['SIGNAL_PRC_CLD']	= signal((close > ssa) and (close > ssb) and ((opn > ssa) or (opn > ssb)),
+						 (close < ssa) and (close < ssb) and ((opn < ssa) or (opn < ssb)))
+		row['SIGNAL_X_PRC_CLD']	= signal((row['SIGNAL_PRC_CLD'] == 1) and (self.prc_cld != 1), (row['SIGNAL_PRC_CLD'] == -1) and (self.prc_cld != -1))
+		row['SIGNAL_X_CHI_KIJ']	= signal((close_1 <= kij_k1) and (close >= kij_k), (close_1 >= kij_k1) and (close <= kij_k))
+		row['SIGNAL_X_KIJ_TEN']	= signal((kij_1 >= ten_1) and (kij < ten), (kij_1 <= ten_1) and (kij > ten))
+		row['SIGNAL_X_KIJ_PRC']	= signal((kij_1 >= close_1) and (kij <= close), (kij_1 <= close_1) and (kij >= close))
+		row['SIGNAL_X_CHI_SSB']	= signal((ssb_k1 >= close_1) and (ssb_k < close), (ssb_k1 <= close_1) and (ssb_k > close))
+		row['SIGNAL_X_CHI_PRC']	= signal((close_k1 >= close_1) and (close_k < close), (close_k1 <= close_1) and (close_k > close))
+		row['SIGNAL_KIJ_PRC']	= signal(kij < close, kij > close)
+		row['SIGNAL_CHI_PRC']	= signal(close > close_k, close < close_k)
+		row['SIGNAL_CHI_KIJ']	= signal(close > kij_k, close < kij_k)
+		row['SIGNAL_KIJ_TEN']	= signal(kij < ten, kij > ten)
+		row['SIGNAL_CHI_SSB']	= signal(close > ssb_k, close < ssb_k)
+
+		nodes = [row['SIGNAL_PRC_CLD'], row['SIGNAL_KIJ_PRC'], row['SIGNAL_CHI_PRC'], row['SIGNAL_CHI_KIJ'], row['SIGNAL_KIJ_TEN'], row['SIGNAL_CHI_SSB']]
+		row['SIGNAL_RATIO_LONG']	= nodes.count(1) * 100 / 6
+		row['SIGNAL_RATIO_SHORT']	= - nodes.count(-1) * 100 / 6
+
+		self.prc_cld = row['SIGNAL_PRC_CLD']
+
+		return row
+
+
+#
+# Process Ichimoku Cloud data from received Yahoo DataFrame
+#
+def processIchimoku(df, config=None):
+	if (config == None):
+		config = CONFIG
+
+	high	= df['high'].to_numpy(dtype=float)
+	low	= df['low'].to_numpy(dtype=float)
+	opn	= df['open'].to_numpy(dtype=float)
+	close	= df['close'].to_numpy(dtype=float)
+
+	lines	= ichimoku_lines(high, low, config)
+	signals	= ichimoku_signals(opn, close, lines, config)
+
+	# Lines & ratios as float32, signals as int8 (all columns added at once)
+	columns = {}
+	for name in lines:
+		columns[name] = lines[name].astype(np.float32)
+	for name in signals:
+		columns[name] = signals[name].astype(np.float32 if name.startswith('SIGNAL_RATIO') else np.int8)
+
+	attrs	= df.attrs
+	df	= pd.concat([df.drop(columns=list(columns), errors='ignore'), pd.DataFrame(columns, index=df.index)], axis=1)
+	df.attrs.update(attrs)
+
+	return df
+
+#
+# SIGNAL_* columns needed by score rules (last 3 bars of each market are used)
+#
+SCORE_FIELDS = ['SIGNAL_X_PRC_CLD', 'SIGNAL_X_KIJ_PRC', 'SIGNAL_X_CHI_PRC', 'SIGNAL_X_CHI_KIJ', 'SIGNAL_X_KIJ_TEN', 'SIGNAL_X_CHI_SSB',
+		'SIGNAL_PRC_CLD', 'SIGNAL_CHI_SSB', 'SIGNAL_KIJ_PRC', 'SIGNAL_RATIO_LONG', 'SIGNAL_RATIO_SHORT']
+
+def signal_tail(df):
+	return df[SCORE_FIELDS].to_numpy(dtype=np.float32)[-3:]
+
+
+#
+# Process scores of many markets at once from stacked signal tails (markets x 3 bars x SCORE_FIELDS)
+#
+def score_batch(stack):
+	sig = {name: stack[:, :, i] for i, name in enumerate(SCORE_FIELDS)}
+
+	return score_signals(sig)[:, -1]
+
+
+#
+# Process score for DataFrame
+#
+def process_score(df):
+	myprint("PROCESSING SCORE...")
+
+	return float(score_batch(signal_tail(df)[np.newaxis])[0])
+
+
+#
+# Process score for every bar of SIGNAL_* arrays (time is last axis), same rules as process_score
+#
+def score_signals(sig):
+	nodes = np.stack([sig['SIGNAL_X_PRC_CLD'], sig['SIGNAL_X_KIJ_PRC'], sig['SIGNAL_X_CHI_PRC'], sig['SIGNAL_X_CHI_KIJ'], sig['SIGNAL_X_KIJ_TEN'], sig['SIGNAL_X_CHI_SSB']])
+	sum_nodes_long = np.sum(nodes == 1, axis=0)
+	sum_nodes_shrt = np.sum(nodes == -1, axis=0)
+
+	# Chikou crosses on the two previous bars
+	chikou = np.stack([lag(sig[name], n, 0) for name in ['SIGNAL_X_CHI_PRC', 'SIGNAL_X_CHI_KIJ', 'SIGNAL_X_CHI_SSB'] for n in [1, 2]])
+
+	def confirmed(side, sum_nodes):
+		# We don't want to receive cloud signal if not confirmed by Chikou
+		cloud	= (sum_nodes == 1) & (nodes[0] == side) & (sig['SIGNAL_CHI_SSB'] != side)
+
+		# We don't want to get false signals from Chikou (bounces, etc.)
+		bounce	= (sum_nodes == 1) & ((nodes[2] == side) | (nodes[3] == side) | (nodes[5] == side)) & np.any(chikou == -side, axis=0)
+
+		# We don't want to buy (sell) if prices are under (above) Kijun
+		kijun	= (sig['SIGNAL_KIJ_PRC'] != side)
+
+		return ~cloud & ~bounce & ~kijun
+
+	# We don't want to keep inside cloud signals & we want to remove contradictory signals
+	outside	= (sig['SIGNAL_PRC_CLD'] != 0)
+	long	= outside & (sum_nodes_long >= 1) & (sum_nodes_shrt == 0) & confirmed(1, sum_nodes_long)
+	short	= outside & (sum_nodes_shrt >= 1) & (sum_nodes_long == 0) & confirmed(-1, sum_nodes_shrt)
+
+	return np.where(long, sig['SIGNAL_RATIO_LONG'], np.where(short, sig['SIGNAL_RATIO_SHORT'], 0))
+
+
+#
+# Report formats : section title, then header, items & end of each non empty group
+#
+REPORT_GROUPS	= ['LONG', 'SHORT', 'CLOSE LONG', 'CLOSE SHORT']
+REPORT_FORMATS	= {
+	'TXT': {
+		'begin':	"",
+		'title':	"SIGNALS {}\n\n",
+		'breadth':	"BREADTH : {:.0f}% above cloud, {:.0f}% under cloud, {} / {} Tenkan-Kijun crosses up / down ({} markets)\n\n",
+		'header':	{group: group + " :\n" for group in REPORT_GROUPS},
+		'item':		{group: "\t- {} : {}%\n" for group in REPORT_GROUPS},
+		'end':		"\n",
+	},
+	'HTML': {
+		'begin':	"<html><body>",
+		'title':	"SIGNALS {}<br/><br/>",
+		'breadth':	"BREADTH : {:.0f}% above cloud, {:.0f}% under cloud, {} / {} Tenkan-Kijun crosses up / down ({} markets)<br/><br/>",
+		'header':	{'LONG': "<span style='color:green'><b>LONG :</b></span><br/><ul>", 'SHORT': "<span style='color:red'><b>SHORT :</b></span><br/><ul>",
+				 'CLOSE LONG': "<span style='color:orange'><b>CLOSE LONG :</b></span><br/><ul>", 'CLOSE SHORT': "<span style='color:orange'><b>CLOSE SHORT :</b></span><br/><ul>"},
+		'item':		{'LONG': "<li><span style='color:green'><b>{} : {}%</b></span></li>", 'SHORT': "<li><span style='color:red'><b>{} : {}%</b></span></li>",
+				 'CLOSE LONG': "<li><span style='color:orange'><b>{} : {}%</b></span></li>", 'CLOSE SHORT': "<li><span style='color:orange'><b>{} : {}%</b></span></li>"},
+		'end':		"</ul><br/>",
+	},
+}
+
+
+#
+# Split scores & closes of one interval & settings in LONG / SHORT / CLOSE groups (single pass, groups sorted afterwards)
+#
+def partition_section(scores, closes, interval):
+	groups = {group: [] for group in REPORT_GROUPS}
+
+	for symbol, score in scores.items():
+		if (score > 66):
+			groups['LONG'].append((symbol, score))
+		elif (score < -66):
+			groups['SHORT'].append((symbol, score))
+
+	groups['LONG'].sort(key=lambda x: x[1], reverse=True)
+	groups['SHORT'].sort(key=lambda x: x[1])
+
+	# Closes are sent for open positions only
+	for symbol, value in sorted(closes.items(), key=lambda x: x[0]):
+		if (value == 1):
+			if get_state().has_position(symbol, interval, "LONG"):
+				groups['CLOSE LONG'].append((symbol, value))
+		else:
+			if get_state().has_position(symbol, interval, "SHORT"):
+				groups['CLOSE SHORT'].append((symbol, value))
+
+	return groups
+
+
+#
+# Generate report chunks for all intervals & settings (TXT / HTML text or JSON document)
+#
+def report(scores, closes, fmt):
+	jobs = [(interval, config) for interval in INTERVALS for config in CONFIGS]
+
+	if (fmt == "JSON"):
+		yield '{"signals": ['
+		for n, (interval, config) in enumerate(jobs):
+			groups = partition_section(scores.get((interval, config), {}), closes.get((interval, config), {}), interval)
+			section = {'interval': interval, 'config': list(config)}
+			if ((interval, config) in breadth):
+				counts = breadth[(interval, config)]
+				section['breadth'] = {'timestamps': counts.timestamps.tolist(), **{name: values.tolist() for name, values in zip(BREADTH_FIELDS, counts.counts)}}
+			for group in REPORT_GROUPS:
+				section[group.lower().replace(" ", "_")] = [{'symbol': symbol, 'score': int(value)} for symbol, value in groups[group]]
+			yield (", " if (n > 0) else "") + json.dumps(section)
+		yield ']}'
+		return
+
+	form	= REPORT_FORMATS[fmt]
+	begin	= True
+
+	for interval, config in jobs:
+		groups = partition_section(scores.get((interval, config), {}), closes.get((interval, config), {}), interval)
+		if all(len(groups[group]) == 0 for group in REPORT_GROUPS):
+			continue
+
+		title = interval
+		if (len(CONFIGS) > 1):
+			title = title + " (" + ",".join(map(str, config)) + ")"
+
+		if begin:
+			yield form['begin']
+			begin = False
+
+		yield form['title'].format(title)
+
+		# Breadth of last bar
+		last = last_breadth(interval, config)
+		if (last != None):
+			counts = breadth[(interval, config)].counts[:, -1]
+			yield form['breadth'].format(last[0], last[1], counts[3], counts[4], counts[0])
+
+		for group in REPORT_GROUPS:
+			if (len(groups[group]) > 0):
+				yield form['header'][group]
+				for symbol, value in groups[group]:
+					yield form['item'][group].format(symbol, int(value))
+				yield form['end']
+
+
+#
+# Write Email with correct values taken from DataFrame (one section per interval & settings)
+#
+def write_email(scores, closes):
+	myprint("BUILDING MESSAGE...")
+
+	MSG = "".join(report(scores, closes, report_format()))
+
+	if (MSG != ""):
+		return MSG
+	else:
+		return None
+
+
+#
+# Report format of output mode (emails are HTML)
+#
+def report_format():
+	if (OUTPUT in ["TXT", "JSON"]):
+		return OUTPUT
+
+	return "HTML"
+
+
+#
+# Result of one market processing (for one interval & settings)
+#
+ScanResult = namedtuple('ScanResult', ['symbol', 'interval', 'config', 'score', 'timestamp', 'close', 'signals'])
+
+
+#
+# Frame of one market & interval, to be processed in a panel of markets
+#
+MarketFrame = namedtuple('MarketFrame', ['symbol', 'interval', 'df'])
+
+
+#
+# Prepare one market for each interval (sharing same Yahoo interval), returns MarketFrames
+#
+def prepare_symbol(symbol, data=FETCH, intervals=None):
+	if (intervals == None):
+		intervals = INTERVALS
+
+	myprint("SYMBOL: " + symbol)
+
+	base 	= get_quote_data(symbol, chart_params(intervals[0])[0], data)
+
+	symbol = symbol.rstrip().replace(".","_").replace("-","_").replace("/","_")
+
+	frames = []
+	for interval in intervals:
+		df = base
+
+		if (interval == "4h") and (df is not None):
+			with metrics.timer("h4", symbol):
+				df = transform_four_hours(df)
+
+		if (df is None) :
+			metrics.count("skipped")
+			continue
+
+		frames.append(MarketFrame(symbol, interval, df))
+
+	return frames
+
+
+#
+# Panel of markets (markets x bars) for Ichimoku : right-aligned on last bar of each market, left-padded
+# with NaN (timestamp 0). Bars of a column are at the same position from each market's end, not at the same time.
+#
+PANEL_FIELDS = ['open', 'high', 'low', 'close']
+
+def build_panel(frames):
+	size	= max(len(frame.df) for frame in frames)
+	panel	= {name: np.full((len(frames), size), np.nan) for name in PANEL_FIELDS}
+
+	panel['timestamp'] = np.zeros((len(frames), size), dtype=np.int64)
+
+	for i, frame in enumerate(frames):
+		for name in PANEL_FIELDS + ['timestamp']:
+			panel[name][i, size - len(frame.df):] = frame.df[name].to_numpy()
+
+	return panel
+
+
+#
+# Breadth of markets on the last BREADTH_BARS timestamps of all markets : markets with data, above / under cloud
+# (state of each market at its last bar at or before timestamp), Tenkan-Kijun crosses up / down (on bars of timestamp only)
+#
+BREADTH_BARS	= 5
+BREADTH_FIELDS	= ['markets', 'above', 'under', 'cross_up', 'cross_down']
+Breadth		= namedtuple('Breadth', ['timestamps', 'counts'])
+
+def breadth_counts(panel, signals):
+	stamps	= panel['timestamp']
+	valid	= ~np.isnan(panel['close'])
+
+	# Last timestamps of all markets are among the last bars of each market
+	window	= np.unique(stamps[:, -BREADTH_BARS:][valid[:, -BREADTH_BARS:]])[-BREADTH_BARS:]
+
+	# Position of each market's last bar at or before each timestamp (markets x timestamps)
+	rows	= np.arange(len(stamps))[:, np.newaxis]
+	pos	= np.maximum((stamps[:, :, np.newaxis] <= window).sum(axis=1) - 1, 0)
+	known	= valid[rows, pos] & (stamps[rows, pos] <= window)
+	fresh	= known & (stamps[rows, pos] == window)
+	cloud	= signals['SIGNAL_PRC_CLD'][rows, pos]
+	cross	= signals['SIGNAL_X_KIJ_TEN'][rows, pos]
+
+	return Breadth(window, np.stack([known.sum(axis=0), (known & (cloud == 1)).sum(axis=0), (known & (cloud == -1)).sum(axis=0), (fresh & (cross == 1)).sum(axis=0), (fresh & (cross == -1)).sum(axis=0)]))
+
+
+#
+# Breadth counts at other timestamps (later than first known one) : market states are carried forward, crosses are not
+#
+def breadth_at(counts, window):
+	pos	= np.searchsorted(counts.timestamps, window, side='right') - 1
+	at	= counts.counts[:, np.maximum(pos, 0)] * (pos >= 0)
+
+	at[3:] *= (counts.timestamps[np.maximum(pos, 0)] == window)
+
+	return at
+
+
+#
+# Add breadth counts of interval & settings (counts of panels & worker processes are summed on all their timestamps)
+#
+def add_breadth(key, counts):
+	if (key in breadth):
+		window		= np.union1d(breadth[key].timestamps, counts.timestamps)[-BREADTH_BARS:]
+		breadth[key]	= Breadth(window, breadth_at(breadth[key], window) + breadth_at(counts, window))
+	else:
+		breadth[key] = counts
+
+
+#
+# Process Ichimoku on panels of markets of one interval (by chunks of markets) for each settings,
+# returns ScanResults to be scored & adds breadth counts
+#
+PANEL_CHUNK = 256
+
+def process_panel(frames, interval):
+	results = []
+
+	for start in range(0, len(frames), PANEL_CHUNK):
+		chunk = frames[start:start + PANEL_CHUNK]
+		panel = build_panel(chunk)
+
+		for config in CONFIGS:
+			with metrics.timer("indicators"):
+				lines	= ichimoku_lines(panel['high'], panel['low'], config)
+				signals	= ichimoku_signals(panel['open'], panel['close'], lines, config)
+				tails	= np.stack([signals[name][:, -3:] for name in SCORE_FIELDS], axis=-1).astype(np.float32)
+
+			add_breadth((interval, config), breadth_counts(panel, signals))
+
+			for frame, tail in zip(chunk, tails):
+				df = frame.df
+				results.append(ScanResult(frame.symbol, interval, config, None, df['timestamp'][len(df)-1], df['close'][len(df)-1], tail))
+
+	return results
+
+
+#
+# Breadth of interval & settings on last bar : percent of markets above & under cloud, None if unknown
+#
+def last_breadth(interval, config):
+	if ((interval, config) not in breadth):
+		return None
+
+	counts = breadth[(interval, config)].counts[:, -1]
+	if (counts[0] == 0):
+		return None
+
+	return counts[1] * 100 / counts[0], counts[2] * 100 / counts[0]
+
+
+#
+# Is signal side confirmed by market breadth (enough markets above / under cloud) ?
+#
+def breadth_allows(interval, config, side):
+	if (BREADTH_FILTER == None):
+		return True
+
+	last = last_breadth(interval, config)
+	if (last == None):
+		return True
+
+	return (last[0] if (side == "LONG") else last[1]) >= BREADTH_FILTER
+
+
+#
+# Process scores of all results at once (signal tails are dropped once scored)
+#
+def score_results(results):
+	if (len(results) == 0):
+		return results
+
+	with metrics.timer("score"):
+		scores = score_batch(np.stack([result.signals for result in results]))
+
+	return [result._replace(score=float(score), signals=None) for result, score in zip(results, scores)]
+
+
+#
+# Prepare one market in pipeline : a market whose chart can not be processed (malformed data) is passed
+#
+def prepare_chart(symbol, data, intervals):
+	try:
+		return prepare_symbol(symbol, data, intervals)
+	except (KeyError, IndexError, TypeError, ValueError) as e:
+		myprint("ERROR: Market " + symbol + " can not be processed (" + repr(e) + "). Passing...")
+		metrics.count("errors")
+		return []
+
+
+#
+# Pipeline : charts are fetched by a producer thread & put in a bounded queue, a consumer prepares market
+# frames meanwhile in a compute thread & processes each panel of PANEL_CHUNK markets of an interval as
+# soon as it is full (network I/O & indicators computation overlap, only one panel per interval is held).
+# Returns ScanResults to be scored.
+#
+PIPELINE_QUEUE = 32
+
+async def scan_pipeline(charts):
+	loop	= asyncio.get_running_loop()
+	queue	= asyncio.Queue(maxsize=PIPELINE_QUEUE)
+	stop	= threading.Event()
+	panels	= {}
+	results	= []
+
+	# Producer blocks while queue is full, None marks the end of charts (even on error).
+	# It stops requesting charts once consumer stopped.
+	def produce():
+		try:
+			with contextlib.closing(charts):
+				for chart in charts:
+					if stop.is_set():
+						break
+					asyncio.run_coroutine_threadsafe(queue.put(chart), loop).result()
+		finally:
+			asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+	# Queue is drained when consumer stops (even on error), so that producer is never blocked on a full queue
+	async def consume(executor):
+		chart = ()
+		try:
+			while True:
+				chart = await queue.get()
+				if (chart == None):
+					break
+
+				symbol, data, intervals = chart
+				for frame in await loop.run_in_executor(executor, prepare_chart, symbol, data, intervals):
+					panel = panels.setdefault(frame.interval, [])
+					panel.append(frame)
+					if (len(panel) >= PANEL_CHUNK):
+						results.extend(await loop.run_in_executor(executor, process_panel, panels.pop(frame.interval), frame.interval))
+
+			# Last panels (not full)
+			for interval in INTERVALS:
+				if (interval in panels):
+					results.extend(await loop.run_in_executor(executor, process_panel, panels.pop(interval), interval))
+		finally:
+			stop.set()
+			while (chart != None):
+				chart = await queue.get()
+
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		await asyncio.gather(loop.run_in_executor(None, produce), consume(executor))
+
+	return results
+
+
+#
+# Raw charts of a list of markets for each Yahoo interval to request
+#
+def shard_charts(symbols):
+	for ntvl, intervals in interval_groups(INTERVALS).items():
+		for symbol, data in market_charts(symbols, ntvl):
+			yield symbol, data, intervals
+
+
+#
+# Retrieve & process a list of markets, returns list of ScanResult
+#
+def scan_shard(symbols):
+	return score_results(asyncio.run(scan_pipeline(shard_charts(symbols))))
+
+
+#
+# Retrieve & process a list of markets in a worker process, returns list of ScanResult, worker metrics & breadth counts
+#
+def run_shard(symbols):
+	global metrics
+	global breadth
+
+	metrics = Metrics()
+	breadth = {}
+	results = scan_shard(symbols)
+
+	return results, metrics.snapshot(), breadth
+
+
+#
+# Worker process initialization (settings are not inherited with 'spawn' start method)
+#
+def init_worker(settings):
+	apply_settings(settings)
+
+
+#
+# Lock a file (shared or exclusive) until it is closed. Files are not locked where fcntl is not available (Windows).
+#
+def lock_file(f, exclusive):
+	try:
+		import fcntl
+	except ImportError:
+		return
+
+	fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+#
+# Signals journal : LONG / SHORT records in one CSV file per month of bar timestamp (schema on first line).
+# Records are buffered during the run, then each file is appended at once under an exclusive lock.
+#
+JOURNAL_FIELDS	= ['side', 'timestamp', 'symbol', 'interval', 'config', 'score', 'close']
+JournalRecord	= namedtuple('JournalRecord', JOURNAL_FIELDS)
+
+class SignalJournal:
+	def __init__(self, path):
+		self.path	= path
+		self.buffer	= {}
+
+	def partition(self, month):
+		return os.path.join(self.path, "signals_" + month + ".csv")
+
+	def append(self, side, timestamp, symbol, interval, config, score, close):
+		month	= datetime.fromtimestamp(int(timestamp), timezone.utc).strftime('%Y-%m')
+		line	= ",".join([side, str(int(timestamp)), symbol, interval, "-".join(map(str, config)), str(int(score)), str(close)])
+		self.buffer.setdefault(month, []).append(line + "\n")
+
+	def flush(self):
+		if (len(self.buffer) == 0):
+			return
+
+		os.makedirs(self.path, exist_ok=True)
+
+		for month, lines in self.buffer.items():
+			fd = os.open(self.partition(month), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+			try:
+				lock_file(fd, True)
+
+				data = "".join(lines)
+				if (os.fstat(fd).st_size == 0):
+					data = ",".join(JOURNAL_FIELDS) + "\n" + data
+
+				data = memoryview(data.encode())
+				while (len(data) > 0):
+					data = data[os.write(fd, data):]
+			finally:
+				os.close(fd)
+
+		self.buffer = {}
+
+	# Records of a symbol and / or time range (epoch seconds) : only files of the range months are read,
+	# and only lines containing the symbol are parsed
+	def query(self, symbol=None, start=None, end=None, side=None):
+		first	= datetime.fromtimestamp(start, timezone.utc).strftime('%Y-%m') if (start != None) else ""
+		last	= datetime.fromtimestamp(end, timezone.utc).strftime('%Y-%m') if (end != None) else "9999-99"
+		needle	= ("," + symbol + ",").encode() if (symbol != None) else b""
+
+		if not os.path.isdir(self.path):
+			return []
+
+		records = []
+		for name in sorted(os.listdir(self.path)):
+			if not (name.startswith("signals_") and name.endswith(".csv")) or not (first <= name[8:-4] <= last):
+				continue
+
+			with open(os.path.join(self.path, name), 'rb') as f:
+				lock_file(f, False)
+				next(f, None)
+
+				for line in f:
+					if (needle not in line):
+						continue
+
+					values = line.decode().rstrip("\n").split(",")
+					record = JournalRecord(values[0], int(values[1]), values[2], values[3], values[4], int(values[5]), float(values[6]))
+
+					if ((symbol == None) or (record.symbol == symbol)) and ((side == None) or (record.side == side)) and ((start == None) or (record.timestamp >= start)) and ((end == None) or (record.timestamp <= end)):
+						records.append(record)
+
+		return records
+
+
+#
+# Return signals journal of the run (single buffered writer)
+#
+def get_journal():
+	global journal
+
+	if (journal == None):
+		journal = SignalJournal(JOURNAL_DIR)
+
+	return journal
+
+
+#
+# Retrieve & process markets (shared between worker processes if several), returns list of ScanResult
+#
+def scan_markets(markets, workers=None):
+	if (workers == None):
+		workers = WORKERS
+
+	if (workers <= 1):
+		return scan_shard(markets)
+
+	results = []
+
+	# Markets are split in small shards so that workers stay busy until the end
+	shard_size	= max(1, len(markets) // (workers * 4))
+	shards		= [markets[i:i + shard_size] for i in range(0, len(markets), shard_size)]
+
+	# Rate limit is shared between workers
+	settings	= current_settings()._replace(rate_limit=RATE_LIMIT / workers)
+
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(settings,)) as executor:
+		for shard, snapshot, counts in executor.map(run_shard, shards):
+			metrics.merge(snapshot)
+			for key in counts:
+				add_breadth(key, counts[key])
+			results += shard
+
+	return results
+
+
+#
+# Library API : scan markets for interval(s) & Ichimoku settings, returns scored ScanResult list
+# (no message, journal nor alerts state). Other settings are Settings fields, e.g. cache_dir='./cache',
+# default ones otherwise (settings of previous calls are not kept).
+# Breadth counts of the scan are then in ichimoku.breadth, per (interval, config).
+#
+#	import ichimoku
+#	for result in ichimoku.scan(['MSFT', 'CS.PA'], '1h,4h', '9,26,52'):
+#		print(result.symbol, result.interval, result.score)
+#
+DEFAULT_SETTINGS = current_settings()
+
+def scan(symbols, interval="1h", config="9,26,52", workers=1, **settings):
+	if isinstance(symbols, str):
+		symbols = symbols.replace(" ", "").split(",")
+	if isinstance(interval, str):
+		interval = interval.replace(" ", "").split(",")
+	if isinstance(config, str) or isinstance(config[0], int):
+		config = [config]
+
+	configs		= [tuple(map(int, c.replace(" ", "").split(","))) if isinstance(c, str) else tuple(c) for c in config]
+	intervals	= list(dict.fromkeys(interval))
+
+	for ntvl in intervals:
+		if (ntvl not in ['30m', '1h', '4h', '1d']):
+			raise ValueError("Interval '" + ntvl + "' not supported.")
+
+	for c in configs:
+		if (len(c) != 3) or not (0 < c[0] < c[1] < c[2]):
+			raise ValueError("Ichimoku settings '" + ",".join(map(str, c)) + "' should be increasing periods (tenkan < kijun < senkou).")
+
+	global breadth
+
+	apply_settings(DEFAULT_SETTINGS._replace(configs=tuple(dict.fromkeys(configs)), intervals=tuple(intervals), output="TXT", **settings))
+	breadth = {}
+
+	return scan_markets(list(symbols), workers)
+
+
+#
+# Alerts state : last alerted score of each market signal & open positions, stored in SQLite.
+# State is loaded once, changes are written in one transaction by commit().
+#
+class AlertState:
+	def __init__(self, path):
+		self.path	= path
+		self.alerts	= {}
+		self.positions	= {}
+		self.changes	= {}
+		self.moves	= {}
+		self.markets	= {}
+		self.ticks	= {}
+		self.previous	= {}
+
+		db = sqlite3.connect(path)
+		try:
+			with db:
+				imported = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='positions'").fetchone() != None
+
+				db.execute("CREATE TABLE IF NOT EXISTS alerts (symbol TEXT, interval TEXT, config TEXT, side TEXT, score INTEGER, timestamp INTEGER, PRIMARY KEY (symbol, interval, config))")
+				db.execute("CREATE TABLE IF NOT EXISTS positions (symbol TEXT, interval TEXT, side TEXT, timestamp INTEGER, PRIMARY KEY (symbol, interval, side))")
+				db.execute("CREATE TABLE IF NOT EXISTS markets (symbol TEXT, interval TEXT, time INTEGER, PRIMARY KEY (symbol, interval))")
+
+				# Positions of MYTRADES marker files (<symbol>_<interval>_long/short) are imported once
+				if not imported:
+					db.executemany("INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?)", self.markers())
+
+			for row in db.execute("SELECT symbol, interval, config, side, score, timestamp FROM alerts"):
+				self.alerts[row[:3]] = row[3:]
+			for row in db.execute("SELECT symbol, interval, side, timestamp FROM positions"):
+				self.positions[row[:3]] = row[3]
+			for row in db.execute("SELECT symbol, interval, time FROM markets"):
+				self.markets[row[:2]] = row[2]
+		finally:
+			db.close()
+
+	def markers(self):
+		if not os.path.isdir(MYTRADES_DIR):
+			return []
+
+		rows = []
+		for name in os.listdir(MYTRADES_DIR):
+			marker = name.rsplit("_", 2)
+			if (len(marker) == 3) and (marker[2] in ['long', 'short']):
+				rows.append((marker[0], marker[1], marker[2].upper(), int(os.path.getmtime(os.path.join(MYTRADES_DIR, name)))))
+
+		return rows
+
+	# Returns True if alert has to be sent : ignored if already sent on same side with equal or superior score,
+	# last alert is forgotten once signal is gone (side None)
+	def alert(self, symbol, interval, config, side, score, timestamp):
+		key	= (symbol, interval, config)
+		last	= self.alerts.get(key)
+
+		self.previous.setdefault(key, last)
+
+		if (side == None):
+			if (last != None):
+				del self.alerts[key]
+				self.changes[key] = None
+			return False
+
+		if (last != None) and (last[0] == side) and (abs(score) <= abs(last[1])):
+			return False
+
+		self.alerts[key]	= (side, score, timestamp)
+		self.changes[key]	= self.alerts[key]
+		return True
+
+	# Forget new alerts (symbol, interval, config) not delivered : last stored alerts are kept
+	def discard(self, alerts):
+		for key in alerts:
+			if (self.changes.get(key) == None):
+				continue
+
+			if (self.previous[key] != None):
+				self.alerts[key] = self.previous[key]
+			else:
+				del self.alerts[key]
+			del self.changes[key]
+
+	def has_position(self, symbol, interval, side):
+		return (symbol, interval, side) in self.positions
+
+	def open_position(self, symbol, interval, side, timestamp):
+		self.positions[(symbol, interval, side)]	= timestamp
+		self.moves[(symbol, interval, side)]		= timestamp
+
+	def close_position(self, symbol, interval, side):
+		self.positions.pop((symbol, interval, side), None)
+		self.moves[(symbol, interval, side)] = None
+
+	# Market time of last processed chart, used for change detection
+	def market_time(self, symbol, interval):
+		return self.markets.get((symbol, interval))
+
+	def set_market_time(self, symbol, interval, market_time):
+		self.markets[(symbol, interval)]	= market_time
+		self.ticks[(symbol, interval)]		= market_time
+
+	def commit(self):
+		if (len(self.changes) == 0) and (len(self.moves) == 0) and (len(self.ticks) == 0):
+			return
+
+		db = sqlite3.connect(self.path)
+		try:
+			with db:
+				db.executemany("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?, ?)", [key + value for key, value in self.changes.items() if (value != None)])
+				db.executemany("DELETE FROM alerts WHERE symbol = ? AND interval = ? AND config = ?", [key for key, value in self.changes.items() if (value == None)])
+				db.executemany("INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?)", [key + (value,) for key, value in self.moves.items() if (value != None)])
+				db.executemany("DELETE FROM positions WHERE symbol = ? AND interval = ? AND side = ?", [key for key, value in self.moves.items() if (value == None)])
+				db.executemany("INSERT OR REPLACE INTO markets VALUES (?, ?, ?)", [key + (value,) for key, value in self.ticks.items()])
+		finally:
+			db.close()
+
+		self.changes	= {}
+		self.moves	= {}
+		self.ticks	= {}
+		self.previous	= {}
+
+
+#
+# Return alerts state (loaded once per run)
+#
+def get_state():
+	global state
+
+	if (state == None):
+		state = AlertState(STATE_FILE)
+
+	return state
+
+
+#
+# Store market result for message (if alert was not already sent) & journal signal.
+# Past analysis (RM_VALUES) reports all signals, without journal nor alerts state.
+#
+def record_result(result):
+	global scores
+
+	side = None
+	if (result.score > 66):
+		side = "LONG"
+	if (result.score < -66):
+		side = "SHORT"
+
+	if (side != None) and (RM_VALUES == 0):
+		get_journal().append(side, result.timestamp, result.symbol, result.interval, result.config, result.score, result.close)
+
+	# Signals against market breadth are not alerted
+	if (side != None) and not breadth_allows(result.interval, result.config, side):
+		metrics.count("breadth_filtered")
+		return
+
+	if (RM_VALUES > 0):
+		scores.setdefault((result.interval, result.config), {})[result.symbol] = result.score
+	elif get_state().alert(result.symbol, result.interval, "-".join(map(str, result.config)), side, int(result.score), int(result.timestamp)) or (side == None):
+		scores.setdefault((result.interval, result.config), {})[result.symbol] = result.score
+	else:
+		metrics.count("suppressed")
+
+
+#
+# Returns of close prices after each horizon (NaN at the end of history)
+#
+def forward_returns(close):
+	returns = {}
+	for h in HORIZONS:
+		returns[h] = lag(close[::-1], h)[::-1] / close - 1
+
+	return returns
+
+
+#
+# Backtest one market : LONG / SHORT signals of every bar with forward returns
+#
+def backtest_symbol(symbol, df, interval, config):
+	df	= processIchimoku(df, config)
+	score	= score_signals({name: df[name].to_numpy() for name in df.columns if name.startswith('SIGNAL_')})
+	close	= df['close'].to_numpy(dtype=float)
+	returns	= forward_returns(close)
+
+	rows = []
+	for i in np.flatnonzero((score > 66) | (score < -66)):
+		side = "LONG" if (score[i] > 0) else "SHORT"
+		rows.append([side, int(df['timestamp'][i]), symbol, interval, "-".join(map(str, config)), int(score[i]), close[i]] + [returns[h][i] for h in HORIZONS])
+
+	return rows
+
+
+#
+# Backtest all markets, write signals to CSV file & print forward returns statistics
+#
+def backtest():
+	rows = []
+
+	for ntvl, intervals in interval_groups(INTERVALS).items():
+		for symbol, data in market_charts(MARKETS, ntvl):
+			myprint("SYMBOL: " + symbol)
+
+			base	= get_quote_data(symbol, ntvl, data)
+			name	= symbol.rstrip().replace(".","_").replace("-","_").replace("/","_")
+
+			for interval in intervals:
+				df = base
+
+				if (interval == "4h") and (df is not None):
+					df = transform_four_hours(df)
+
+				if (df is None):
+					continue
+
+				for config in CONFIGS:
+					rows += backtest_symbol(name, df, interval, config)
+
+	with open(BACKTEST, 'w') as f:
+		f.write(",".join(["side", "timestamp", "symbol", "interval", "config", "score", "close"] + ["return_" + str(h) for h in HORIZONS]) + "\n")
+		for row in rows:
+			f.write(",".join(map(str, row)) + "\n")
+
+	# Forward returns statistics (returns of SHORT signals are inverted)
+	MSG = ""
+	for interval in INTERVALS:
+		for config in CONFIGS:
+			MSG = MSG + "BACKTEST " + interval + " (" + ",".join(map(str, config)) + ")\n\n"
+
+			for side, sign in [("LONG", 1), ("SHORT", -1)]:
+				side_rows = [row for row in rows if (row[0] == side) and (row[3] == interval) and (row[4] == "-".join(map(str, config)))]
+				MSG = MSG + side + " : " + str(len(side_rows)) + " signals\n"
+
+				for k, h in enumerate(HORIZONS):
+					returns = sign * np.array([row[7 + k] for row in side_rows], dtype=float)
+					returns = returns[~np.isnan(returns)]
+					if (len(returns) > 0):
+						MSG = MSG + "\t- " + str(h) + " bars : " + "{:+.2f}".format(np.mean(returns) * 100) + "% avg, " + str(int(np.mean(returns > 0) * 100)) + "% hit (" + str(len(returns)) + ")\n"
+
+				MSG = MSG + "\n"
+
+	print(MSG)
+
+	if (METRICS_FILE != None):
+		metrics.write(METRICS_FILE, METRICS_FORMAT)
+
+
+#
+# Sweep grid of Ichimoku settings from 'TENKANS:KIJUNS:SENKOUS' (each '9', '7,9' or '5-12/1'), increasing periods only
+#
+def sweep_grid(spec):
+	def periods(part):
+		values = []
+		for item in part.split(","):
+			if ("-" in item):
+				bounds, step = (item.split("/") + ["1"])[:2]
+				start, end = bounds.split("-")
+				values += list(range(int(start), int(end) + 1, max(1, int(step))))
+			else:
+				values.append(int(item))
+		return values
+
+	parts = spec.replace(" ", "").split(":")
+	if (len(parts) != 3):
+		raise ValueError(spec)
+
+	return [config for config in itertools.product(*map(periods, parts)) if (0 < config[0] < config[1] < config[2])]
+
+
+#
+# Sweep one market : signals of every setting of the grid, from one range index of the market.
+# Forward returns are summed in stats : config -> [signals, [sum, hits, count] per horizon]
+#
+def sweep_symbol(df, stats):
+	high	= df['high'].to_numpy(dtype=float)
+	low	= df['low'].to_numpy(dtype=float)
+	opn	= df['open'].to_numpy(dtype=float)
+	close	= df['close'].to_numpy(dtype=float)
+
+	index	= RangeIndex(high, low)
+	returns	= forward_returns(close)
+
+	for config in SWEEP:
+		score	= score_signals(ichimoku_signals(opn, close, ichimoku_lines(high, low, config, index.midpoint), config))
+		sign	= np.where(score > 66, 1, np.where(score < -66, -1, 0))
+		signals	= np.flatnonzero(sign)
+
+		stat = stats.setdefault(config, [0, [[0.0, 0, 0] for h in HORIZONS]])
+		stat[0] += len(signals)
+
+		for k, h in enumerate(HORIZONS):
+			signed	= sign[signals] * returns[h][signals]
+			signed	= signed[~np.isnan(signed)]
+			stat[1][k][0] += np.sum(signed)
+			stat[1][k][1] += int(np.sum(signed > 0))
+			stat[1][k][2] += len(signed)
+
+
+#
+# Sweep all markets, print settings of the grid ranked by average forward return (last horizon), then hit ratio
+#
+SWEEP_TOP = 20
+
+def sweep():
+	for ntvl, intervals in interval_groups(INTERVALS).items():
+		stats = {interval: {} for interval in intervals}
+
+		for symbol, data in market_charts(MARKETS, ntvl):
+			myprint("SYMBOL: " + symbol)
+
+			base = get_quote_data(symbol, ntvl, data)
+
+			for interval in intervals:
+				df = base
+
+				if (interval == "4h") and (df is not None):
+					df = transform_four_hours(df)
+
+				if (df is None):
+					continue
+
+				with metrics.timer("sweep", symbol):
+					sweep_symbol(df, stats[interval])
+
+		for interval in intervals:
+			ranking = []
+			for config, (signals, horizons) in stats[interval].items():
+				ranking.append({
+					'config':	list(config),
+					'signals':	signals,
+					'returns':	{str(h): (total / count if (count > 0) else None) for h, (total, hits, count) in zip(HORIZONS, horizons)},
+					'hits':		{str(h): (hits / count if (count > 0) else None) for h, (total, hits, count) in zip(HORIZONS, horizons)},
+				})
+
+			last = str(HORIZONS[-1])
+			ranking.sort(key=lambda x: (x['returns'][last] if (x['returns'][last] != None) else -np.inf, x['hits'][last] or 0), reverse=True)
+
+			if (OUTPUT == "JSON"):
+				print(json.dumps({'interval': interval, 'horizon': HORIZONS[-1], 'ranking': ranking}))
+				continue
+
+			MSG = "SWEEP " + interval + " : " + str(len(ranking)) + " settings ranked by " + last + " bars forward returns\n\n"
+			for rank in ranking[:SWEEP_TOP]:
+				MSG = MSG + "\t- " + ",".join(map(str, rank['config'])) + " : " + str(rank['signals']) + " signals"
+				for h in HORIZONS:
+					if (rank['returns'][str(h)] != None):
+						MSG = MSG + ", " + str(h) + " bars " + "{:+.2f}".format(rank['returns'][str(h)] * 100) + "% (" + str(int(rank['hits'][str(h)] * 100)) + "% hit)"
+				MSG = MSG + "\n"
+
+			print(MSG)
+
+	if (METRICS_FILE != None):
+		metrics.write(METRICS_FILE, METRICS_FORMAT)
+
+
+#
+# Whole markets history is processed (backtest & sweep), instead of last bars only
+#
+def full_history():
+	return (BACKTEST != None) or (SWEEP != None)
+
+
+#
+# Flush signals journal, write & send message for current scores (waiting for emails delivery if wait)
+#
+def send_results(wait=False):
+	with metrics.timer("journal"):
+		get_journal().flush()
+
+	deliveries = []
+
+	with metrics.timer("output"):
+		if (OUTPUT == "EMAIL"):
+			for recipients, title, MSG, alerts in digests(scores, closes):
+				deliveries.append((alerts, send_email(MSG + "</body></html>", recipients, title)))
+		else:
+			# Report is written to output as it is generated
+			empty = True
+			for chunk in report(scores, closes, report_format()):
+				sys.stdout.write(chunk)
+				empty = empty and (chunk == "")
+			if not empty:
+				sys.stdout.write("\n")
+
+	# Alerts are stored as sent once their messages are delivered (alerts of a failed message are sent again next run)
+	with metrics.timer("state"):
+		for alerts, delivery in deliveries:
+			if not delivery.result():
+				get_state().discard(alerts)
+		get_state().commit()
+
+	if wait:
+		close_notifier()
+
+	if (METRICS_FILE != None):
+		metrics.write(METRICS_FILE, METRICS_FORMAT)
+
+
+#
+# Daemon : bars of each market are kept in memory and markets are processed again at each bar close
+#
+def daemon():
+	global scores
+	global closes
+	global breadth
+
+	groups		= interval_groups(INTERVALS)
+	markets		= {}
+
+	# Only last bars are needed for Ichimoku on last candles (whole history for H4 candles)
+	lookback	= 2 * max(2 * config[1] + config[2] for config in CONFIGS)
+
+	# Daily bars close with the trading session, intraday bars after their period
+	def bar_close(ntvl, bars, meta):
+		if (ntvl == "1d"):
+			return meta.get('currentTradingPeriod', {}).get('regular', {}).get('end', bars['timestamp'][-1] + INTERVAL_SECONDS[ntvl])
+
+		return bars['timestamp'][-1] + INTERVAL_SECONDS[ntvl]
+
+	# Known markets are updated with new bars only (not requested while their last bar is not closed),
+	# others are requested for the whole range. A daily bar finalized under the same timestamp is a new bar.
+	def fetch_update(symbol, ntvl):
+		ntvl, rng	= chart_params(ntvl)
+		key		= (ntvl, symbol)
+
+		if (key in markets):
+			bars, meta, size = markets[key]
+			close = bar_close(ntvl, bars, meta)
+
+			if (close + DAEMON_DELAY > time.time()):
+				return None
+
+			new, meta = request_tail(symbol, ntvl, bars, meta)
+
+			if (new is None):
+				return None
+
+			if (new['timestamp'][-1] == bars['timestamp'][-1]) and not ((ntvl == "1d") and (new[-1].tolist() != bars[-1].tolist())):
+				return None
+
+			markets[key] = [new[-size:], meta, size]
+		else:
+			data = fetch_chart(symbol, ntvl)
+
+			if (data == None) or (data['chart']['result'] == None):
+				return data
+
+			body = data['chart']['result'][0]
+			bars = body_to_bars(body)
+			markets[key] = [bars, body['meta'], len(bars)]
+
+		bars, meta, size = markets[key]
+		return bars_to_chart(bars if ("4h" in groups[ntvl]) else bars[-lookback:], meta)
+
+	# Markets without new bar are not processed again
+	def new_charts():
+		for ntvl, intervals in groups.items():
+			for symbol, data in fetch_all(MARKETS, ntvl, fetch_update):
+				if (data != None) or ((ntvl, symbol) not in markets):
+					yield symbol, data, intervals
+
+	try:
+		while True:
+			myprint("DAEMON: PROCESSING NEW BARS...")
+
+			scores	= {}
+			closes	= {}
+			breadth	= {}
+			results	= asyncio.run(scan_pipeline(new_charts()))
+
+			for result in score_results(results):
+				record_result(result)
+
+			send_results()
+
+			# Waiting for next bar close (next interval if all markets are closed). Bars expected but not
+			# published yet are requested again after DAEMON_RETRY seconds, during DAEMON_RETRY_WINDOW seconds.
+			now	= time.time()
+			closing	= [bar_close(key[0], bars, meta) + DAEMON_DELAY for key, (bars, meta, size) in markets.items()]
+			missing	= [close for close in closing if (now - DAEMON_RETRY_WINDOW < close <= now)]
+			pending	= [close for close in closing if (close > now)]
+
+			wake	= now + min(INTERVAL_SECONDS[ntvl] for ntvl in groups)
+			if (len(pending) > 0):
+				wake = min(pending)
+			if (len(missing) > 0):
+				wake = min(wake, now + DAEMON_RETRY)
+
+			myprint("DAEMON: SLEEPING UNTIL " + datetime.fromtimestamp(wake).strftime('%d/%m %H:%M:%S'))
+			time.sleep(wake - now)
+	except KeyboardInterrupt:
+		close_notifier()
+		myprint("DAEMON: STOPPED.")
+
+
+#
+# Main function
+#
+def main():
+	global scores
+	global closes
+
+	if BUILD_ARCHIVE:
+		build_archive()
+		return
+
+	if (BACKTEST != None):
+		backtest()
+		return
+
+	if (SWEEP != None):
+		sweep()
+		return
+
+	# Positions given on command line are stored before processing markets
+	for action, symbol, interval, side in POSITIONS:
+		if (action == "open"):
+			get_state().open_position(symbol, interval, side, int(time.time()))
+		else:
+			get_state().close_position(symbol, interval, side)
+
+	if DAEMON:
+		daemon()
+		return
+
+	# Charts are requested only for markets which changed since last run (results of others would be the same),
+	# except for past analysis
+	detect	= DETECT_CHANGES and (ARCHIVE_DIR == None) and (RM_VALUES == 0)
+	markets	= MARKETS
+	if detect:
+		markets, times = changed_markets(MARKETS)
+
+	# For each market, retrieve (concurrently), process and write in email
+	results = scan_markets(markets)
+
+	for result in results:
+		record_result(result)
+
+	# Market times are stored for processed markets only
+	if detect:
+		processed = set((result.symbol, result.interval) for result in results)
+		for symbol, market_time in times.items():
+			for interval in INTERVALS:
+				if ((symbol.rstrip().replace(".","_").replace("-","_").replace("/","_"), interval) in processed):
+					get_state().set_market_time(symbol, interval, market_time)
+
+	# Write & send message
+	send_results(True)
 
 
 ################################################### START PROGRAM ##################################################################
-parse_args()
-main()
-myprint("--- %s seconds ---" % (time.time() - start_time))
+if __name__ == "__main__":
+	parse_args()
+	main()
+	myprint("--- %s seconds ---" % (time.time() - start_time))